@@ -0,0 +1,285 @@
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import time
+from array import array
+
+import numpy as np
+from tqdm import tqdm
+
+from constants import BOARD_HEIGHT, BOARD_WIDTH
+from myLogger import getModuleLogger
+from tetrisClasses import Board
+from tetrisPieceGenerator import PIECES_BY_NUMBER
+from tetrisUtilities import get_all_legal_moves
+from workScheduler import WorkScheduler
+
+# Boards are keyed by their BOARD_HEIGHT row bitmasks as uint16s, colors are left out so boards with the same shape are one board
+KEY_BYTES = 2 * BOARD_HEIGHT
+# Guess of placements per board for the first level, later levels use the branching of the level before
+MAX_BRANCHING = 4 * BOARD_WIDTH
+# Deduplicating sorts the keys, which takes about this many times their size
+SORT_OVERHEAD = 3
+# Odd constants that mix the rows into the partition a key goes to, the sums wrap around like a multiplicative hash
+PARTITION_MULTIPLIERS = (np.arange(1, BOARD_HEIGHT + 1, dtype=np.uint64) *
+                         np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+
+
+def uniqueKeys(keys: np.ndarray) -> np.ndarray:
+    """
+    Removes duplicate boards from an (N, BOARD_HEIGHT) key array, the result is sorted
+    """
+    if len(keys) == 0:
+        return keys
+    rows = np.ascontiguousarray(keys).view(np.dtype(
+        (np.void, KEY_BYTES))).ravel()
+    return np.unique(rows).view(np.uint16).reshape(-1, BOARD_HEIGHT)
+
+
+def partitionOf(keys: np.ndarray, numPartitions) -> np.ndarray:
+    mixed = (keys.astype(np.uint64) * PARTITION_MULTIPLIERS).sum(axis=1)
+    return ((mixed >> np.uint64(32)) % np.uint64(numPartitions)).astype(
+        np.intp)
+
+
+def readKeys(source) -> np.ndarray:
+    """
+    Sources are either key arrays or (file, first board, end board) ranges of a key file
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    path, start, end = source
+    return np.fromfile(path,
+                       dtype="<u2",
+                       count=(end - start) * BOARD_HEIGHT,
+                       offset=start * KEY_BYTES).reshape(-1, BOARD_HEIGHT)
+
+
+def chunkSources(frontier, chunkSize) -> list:
+    # The frontier is a list of key arrays and (key file, number of boards) pairs
+    sources = []
+    for block in frontier:
+        if isinstance(block, np.ndarray):
+            sources.extend(block[start:start + chunkSize]
+                           for start in range(0, len(block), chunkSize))
+        else:
+            path, count = block
+            sources.extend((path, start, min(start + chunkSize, count))
+                           for start in range(0, count, chunkSize))
+    return sources
+
+
+def chunkedKeys(frontier, chunkSize=1 << 16):
+    for source in chunkSources(frontier, chunkSize):
+        yield readKeys(source)
+
+
+def concatKeys(keys: list) -> np.ndarray:
+    if not keys:
+        return np.zeros((0, BOARD_HEIGHT), dtype=np.uint16)
+    return np.concatenate(keys)
+
+
+class LevelExpander:
+    """
+    Places a piece on every board of a chunk of the frontier, runs in the worker processes
+    Jobs are (piece number, source, spill), returns (children, losing boards, number of placements)
+    Without spill the deduplicated children are sent back, with spill = (directory, partitions)
+    they are appended to the partition files of the level instead and children is None
+    A board is losing when it has topped out or the piece has no legal placement on it
+    """
+
+    def __call__(self, job):
+        pieceNumber, source, spill = job
+        piece = PIECES_BY_NUMBER[pieceNumber]
+        children = array("H")
+        losing = []
+        for rows in readKeys(source).tolist():
+            board = Board.from_rows(rows)
+            moves = get_all_legal_moves(board, piece) if rows[0] == 0 else ()
+            if not moves:
+                losing.append(rows)
+                continue
+            for move in moves:
+                children.extend(board.make_move(piece, move)[0].get_rows())
+        placements = len(children) // BOARD_HEIGHT
+        children = uniqueKeys(
+            np.frombuffer(children, dtype=np.uint16).reshape(-1, BOARD_HEIGHT))
+        losing = np.array(losing, dtype=np.uint16).reshape(-1, BOARD_HEIGHT)
+        if spill is None:
+            return children, losing, placements
+        directory, numPartitions = spill
+        parts = partitionOf(children, numPartitions)
+        order = np.argsort(parts, kind="stable")
+        bounds = np.searchsorted(parts[order], np.arange(numPartitions + 1))
+        for p in range(numPartitions):
+            if bounds[p] == bounds[p + 1]:
+                continue
+            # Every worker has its own file per partition, so appends never interleave
+            with open(
+                    os.path.join(directory,
+                                 "part{}-{}.bin".format(p, os.getpid())),
+                    "ab") as f:
+                f.write(children[order[bounds[p]:bounds[p + 1]]].astype(
+                    "<u2").tobytes())
+        return None, losing, placements
+
+
+def mergePartitions(directory, numPartitions) -> list:
+    """
+    Deduplicates every partition of a spilled level into one key file, returns the (key file, number of boards) pairs
+    """
+    frontier = []
+    for p in range(numPartitions):
+        paths = glob.glob(os.path.join(directory, "part{}-*.bin".format(p)))
+        if not paths:
+            continue
+        keys = uniqueKeys(
+            np.concatenate([
+                np.fromfile(path, dtype="<u2").reshape(-1, BOARD_HEIGHT)
+                for path in paths
+            ]))
+        merged = os.path.join(directory, "part{}.bin".format(p))
+        keys.astype("<u2").tofile(merged)
+        for path in paths:
+            os.remove(path)
+        frontier.append((merged, len(keys)))
+    return frontier
+
+
+class BoardEnumeration:
+    """
+    The boards reachable with a sequence of pieces, as left by enumerateBoards
+    levels has the statistics of every level, losing the keys of the losing boards of every level
+    The final boards can be on disk, keys() and boards() stream them a chunk at a time
+    """
+
+    def __init__(self, levels, losing, frontier, directory,
+                 ownsDirectory) -> None:
+        self.levels = levels
+        self.losing = losing
+        self.frontier = frontier
+        self.directory = directory
+        self.ownsDirectory = ownsDirectory
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.levels[-1]["boards"] if self.levels else 1
+
+    def keys(self, chunkSize=1 << 16):
+        return chunkedKeys(self.frontier, chunkSize)
+
+    def boards(self):
+        for keys in self.keys():
+            for rows in keys.tolist():
+                yield Board.from_rows(rows)
+
+    def close(self) -> None:
+        if self.ownsDirectory and self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+def enumerateBoards(pieces: list,
+                    numWorkers=1,
+                    memoryBudget=1 << 30,
+                    spillDir=None,
+                    chunkSize=2048) -> BoardEnumeration:
+    """
+    Finds every board reachable from an empty board by placing the pieces in order, tucks and slides included
+    Each level is split into chunks that numWorkers processes expand, duplicates are removed by their row keys
+    When the placements of a level would not fit in memoryBudget bytes, they are hash partitioned into files in spillDir
+    (a temporary directory by default) so every partition can be deduplicated on its own
+    """
+    logger = getModuleLogger(__name__, logging.INFO)
+    ownsDirectory = spillDir is None
+    directory = tempfile.mkdtemp(
+        prefix="boards-") if ownsDirectory else spillDir
+    os.makedirs(directory, exist_ok=True)
+    frontier = [np.zeros((1, BOARD_HEIGHT), dtype=np.uint16)]
+    numBoards = 1
+    branching = MAX_BRANCHING
+    levels = []
+    losing = []
+    previousDir = None
+    expander = LevelExpander()
+    scheduler = None
+    if numWorkers > 1:
+        # Speculative copies are off, a second copy of a chunk could still be appending to the partition files while they are merged
+        scheduler = WorkScheduler(expander,
+                                  numWorkers=numWorkers,
+                                  speculate=False)
+    try:
+        for level, piece in enumerate(pieces, 1):
+            startTime = time.time()
+            estimate = numBoards * branching * KEY_BYTES * SORT_OVERHEAD
+            numPartitions = max(1, int(-(-estimate // memoryBudget)))
+            spill = None
+            levelDir = None
+            if numPartitions > 1:
+                levelDir = os.path.join(directory, "level{}".format(level))
+                os.makedirs(levelDir, exist_ok=True)
+                spill = (levelDir, numPartitions)
+            jobs = [(piece.number, source, spill)
+                    for source in chunkSources(frontier, chunkSize)]
+            if scheduler is None:
+                results = enumerate(map(expander, jobs))
+            else:
+                results = scheduler.map(jobs)
+            children = []
+            levelLosing = []
+            placements = 0
+            for _, (kids, lost, numPlacements) in tqdm(results,
+                                                       total=len(jobs),
+                                                       desc=piece.name):
+                if kids is not None:
+                    children.append(kids)
+                levelLosing.append(lost)
+                placements += numPlacements
+            if spill is None:
+                frontier = [uniqueKeys(concatKeys(children))]
+            else:
+                frontier = mergePartitions(levelDir, numPartitions)
+            # The boards of the level before are only needed until they are expanded
+            if previousDir is not None:
+                shutil.rmtree(previousDir, ignore_errors=True)
+            previousDir = levelDir
+            lost = concatKeys(levelLosing)
+            losing.append(lost)
+            if levels:
+                levels[-1]["losing"] = len(lost)
+            expanded = numBoards - len(lost)
+            numBoards = sum(
+                len(block) if isinstance(block, np.ndarray) else block[1]
+                for block in frontier)
+            branching = placements / expanded if expanded else MAX_BRANCHING
+            levels.append(
+                dict(piece=piece.name,
+                     boards=numBoards,
+                     placements=placements,
+                     losing=0,
+                     partitions=numPartitions,
+                     seconds=time.time() - startTime))
+            logger.info(
+                "Level {} ({}): {} boards from {} placements, {} partitions, {:.1f}s"
+                .format(level, piece.name, numBoards, placements,
+                        numPartitions,
+                        time.time() - startTime))
+    finally:
+        if scheduler is not None:
+            scheduler.close()
+    # There is no next piece to check the last level with, only the boards that topped out lose
+    losing.append(
+        concatKeys([keys[keys[:, 0] != 0] for keys in chunkedKeys(frontier)]))
+    if levels:
+        levels[-1]["losing"] = len(losing[-1])
+    # losing[0] are the losing boards of the empty board level, which never loses
+    return BoardEnumeration(levels, losing[1:], frontier, directory,
+                            ownsDirectory)
@@ -0,0 +1,77 @@
+import gzip
+import os
+import pickle
+import threading
+
+
+def writeAtomic(path, data: bytes) -> None:
+    """
+    Writes the bytes next to path and renames them over it, so path always holds either the old or the new file in full
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    tmpPath = os.path.join(
+        directory, ".{}.{}.tmp".format(os.path.basename(path), os.getpid()))
+    try:
+        with open(tmpPath, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+    if hasattr(os, "O_DIRECTORY"):
+        # The rename itself is only durable once the directory is synced
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def readCheckpoint(path):
+    with gzip.open(path, "rb") as f:
+        return pickle.load(f)
+
+
+class CheckpointWriter:
+    """
+    Writes gzipped pickles in a background thread so a run does not wait on compression and the disk
+    The state is pickled straight away in the calling thread, so the caller can keep changing it afterwards
+    At most one write is in flight, a new save waits for the previous one, and an error in the writer is raised on the next save or wait
+    """
+
+    def __init__(self, compressLevel=6) -> None:
+        self.compressLevel = compressLevel
+        self.thread = None
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.wait()
+
+    def save(self, path, state) -> None:
+        data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        self.wait()
+        self.thread = threading.Thread(target=self.write,
+                                       args=(path, data),
+                                       daemon=True)
+        self.thread.start()
+
+    def write(self, path, data) -> None:
+        try:
+            writeAtomic(path,
+                        gzip.compress(data, compresslevel=self.compressLevel))
+        except Exception as e:
+            self.error = e
+
+    def wait(self) -> None:
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
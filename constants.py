@@ -1,4 +1,7 @@
 BOARD_WIDTH = 10
 BOARD_HEIGHT = 20
 
-BLOCK_CHARACTER = "\u2588"
\ No newline at end of file
+BLOCK_CHARACTER = "\u2588"
+
+# Board rows are stored as bitmasks, this is a row with every column filled
+FULL_ROW = (1 << BOARD_WIDTH) - 1
@@ -0,0 +1,91 @@
+import hashlib
+
+import numpy as np
+
+from transpositionTable import TranspositionTable
+
+
+def weightsKey(weights) -> str:
+    """
+    Hash of a weight vector, equal weights always give the same key
+    """
+    return hashlib.blake2b(np.asarray(weights, dtype=np.float64).tobytes(),
+                           digest_size=16).hexdigest()
+
+
+def genomeKey(genome) -> str:
+    """
+    Fingerprint of a neat genome, made from everything that changes its network: the node genes and the enabled connections
+    Genome ids are left out, so an elite copied into the next generation keeps its key
+    """
+    nodes = sorted(
+        (key, node.bias, node.response, node.activation, node.aggregation)
+        for key, node in genome.nodes.items())
+    connections = sorted((key, conn.weight)
+                         for key, conn in genome.connections.items()
+                         if conn.enabled)
+    return hashlib.blake2b(repr((nodes, connections)).encode(),
+                           digest_size=16).hexdigest()
+
+
+class FitnessRecord:
+    """
+    Everything known about the fitness of one genome under one scoring type
+    Games on shared piece sequences are kept under the seed of their sequence, so the same game is never counted twice
+    Games with random pieces are just added, and a mean can also be added on its own when the single games are not known
+    """
+
+    def __init__(self) -> None:
+        self.scores = []
+        self.seeds = set()
+        self.extraTotal = 0.0
+        self.extraGames = 0
+
+    def add_games(self, scores, seeds=None) -> None:
+        for i, score in enumerate(scores):
+            if seeds is not None:
+                if seeds[i] in self.seeds:
+                    continue
+                self.seeds.add(seeds[i])
+            self.scores.append(score)
+
+    def add_mean(self, mean, numGames) -> None:
+        self.extraTotal += mean * numGames
+        self.extraGames += numGames
+
+    @property
+    def numGames(self) -> int:
+        return len(self.scores) + self.extraGames
+
+    def mean(self) -> float:
+        return (sum(self.scores) + self.extraTotal) / self.numGames
+
+
+class FitnessStore:
+    """
+    Remembers the fitness of genomes between generations, so elites that are carried over unchanged are not replayed
+    Records are keyed by (genome key, scoring type), the genome key is weightsKey or genomeKey
+    Only the maxGenomes most recently used genomes are kept
+    """
+
+    def __init__(self, maxGenomes=100000) -> None:
+        self.table = TranspositionTable(maxGenomes)
+
+    def get(self, key: str, scoring: str) -> FitnessRecord:
+        """
+        Returns the record of the genome, or None if it was never evaluated
+        """
+        return self.table.get((key, scoring))
+
+    def record(self, key: str, scoring: str) -> FitnessRecord:
+        """
+        Returns the record of the genome, making an empty one if there is none yet
+        """
+        record = self.table.get((key, scoring))
+        if record is None:
+            record = FitnessRecord()
+            self.table.put((key, scoring), record)
+        return record
+
+    def stats(self) -> dict:
+        return self.table.stats()
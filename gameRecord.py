@@ -0,0 +1,85 @@
+from array import array
+from dataclasses import dataclass
+
+from piece import PIECES
+from piece import Piece
+from tetrisClasses import Board, Move
+
+# Every step of a game fits in 16 bits: piece number (3 bits), rotation number (2 bits), x + 3 (4 bits) and y + 3 (5 bits)
+# x and y are the top left of the 4x4 rotation matrix, so they go down to -3 when the blocks are at the bottom right of the matrix
+STEP_OFFSET = 3
+PIECE_SHIFT = 11
+ROTATION_SHIFT = 9
+X_SHIFT = 5
+
+PIECES_BY_NUMBER = {p.number: p for p in PIECES}
+
+
+@dataclass(frozen=True)
+class GameStep:
+    board: Board  # The board after the piece was placed and any rows were cleared
+    piece: Piece
+    move: Move
+    rowsCleared: int
+
+
+def encodeStep(piece, move: Move) -> int:
+    return (piece.number << PIECE_SHIFT
+            | move.rotation << ROTATION_SHIFT
+            | (move.x + STEP_OFFSET) << X_SHIFT | (move.y + STEP_OFFSET))
+
+
+def decodeStep(code: int):
+    """
+    Returns the (piece, move) of an encoded step
+    """
+    piece = PIECES_BY_NUMBER[code >> PIECE_SHIFT]
+    move = Move((code >> X_SHIFT & 0xF) - STEP_OFFSET,
+                (code & 0x1F) - STEP_OFFSET, code >> ROTATION_SHIFT & 0x3)
+    return piece, move
+
+
+class GameRecord:
+    """
+    The pieces and moves of a game packed into two bytes per step
+    Boards are not stored, boards() replays them from an empty board when they are needed
+    """
+
+    def __init__(self, steps=None) -> None:
+        self.steps = array("H", steps or [])
+
+    def append(self, piece, move: Move) -> None:
+        self.steps.append(encodeStep(piece, move))
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def __getitem__(self, i):
+        return decodeStep(self.steps[i])
+
+    def __iter__(self):
+        return (decodeStep(code) for code in self.steps)
+
+    def moves(self) -> list:
+        return [move for _, move in self]
+
+    def pieces(self) -> list:
+        return [piece for piece, _ in self]
+
+    def boards(self, trackColors=True):
+        """
+        Yields the board after every step
+        """
+        board = Board(trackColors=trackColors)
+        for piece, move in self:
+            board, _ = board.make_move(piece, move)
+            yield board
+
+    def tobytes(self) -> bytes:
+        return self.steps.tobytes()
+
+    @staticmethod
+    def frombytes(data: bytes):
+        record = GameRecord()
+        record.steps.frombytes(data)
+        return record
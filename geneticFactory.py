@@ -1,20 +1,19 @@
 import logging
-import queue
 import random
 from tqdm import tqdm
-from multiprocessing import Process, Queue
 import time
-import tensorflow as tf
 from typing import List, Tuple
+import numpy as np
 
-# Using a GPU is kinda unnecesssary here and threading is faster since we dont actually train any models
-tf.config.set_visible_devices([], 'GPU')
-
-from tetrisSimulation import TetrisSimulation
+from tetrisSimulation import TetrisSimulation, VectorTetrisSimulation, LinearPopulationSimulation
 from myLogger import getModuleLogger
+from workScheduler import WorkScheduler
 from tetrisAgent import FeatureAgent, NetworkAgent
 from tetrisClasses import Board, Piece, Move, TetrisPlacementState
+from pieceSequences import SharedPieceSequences
 from hueristics import featureVector
+from fitnessStore import FitnessStore, weightsKey
+from checkpointWriter import CheckpointWriter, readCheckpoint
 import csv
 
 
@@ -26,7 +25,14 @@ class GeneticFactory:
                  linear=True,
                  numGames=5,
                  scoring='lines',
-                 csvFile=None) -> None:
+                 csvFile=None,
+                 commonPieces=False,
+                 racingSchedule=None,
+                 racingZ=2.0,
+                 memoize=False,
+                 refineGames=0,
+                 checkpointInterval=None,
+                 checkpointPrefix='genetic-checkpoint-') -> None:
         self.logger = getModuleLogger(__name__, logging.DEBUG)
         b = Board()
         # We find the number of weights based on the number of features on an empty board
@@ -43,6 +49,39 @@ class GeneticFactory:
         self.numGames = numGames
         self.scoring = scoring
         self.csvFile = csvFile
+        # With common pieces every genome of a generation plays the same numGames piece sequences
+        self.commonPieces = commonPieces
+        # Racing plays every genome up to racingSchedule[0] games, then drops the genomes that are racingZ standard errors
+        # behind the last genome that would be kept, and so on for each entry, the survivors finish all numGames games
+        self.racingSchedule = tuple(racingSchedule or ())
+        for a, b in zip((0, ) + self.racingSchedule,
+                        self.racingSchedule + (numGames, )):
+            if a >= b:
+                raise ValueError(
+                    "The racing schedule must be increasing game counts below numGames"
+                )
+        self.racingZ = racingZ
+        # With memoize, genomes that already played numGames games (the elites computeNextGeneration carries over) are not replayed
+        # They only play refineGames more games each generation, which are added to their running mean
+        self.fitnessStore = FitnessStore() if memoize else None
+        self.refineGames = refineGames
+        # Every checkpointInterval generations the whole run is saved to checkpointPrefix + the number of finished generations
+        self.checkpointInterval = checkpointInterval
+        self.checkpointPrefix = checkpointPrefix
+        # Everything needed to build the same factory again when resuming
+        self.settings = dict(totalPopulation=totalPopulation,
+                             linear=linear,
+                             numGames=numGames,
+                             scoring=scoring,
+                             commonPieces=commonPieces,
+                             racingSchedule=racingSchedule,
+                             racingZ=racingZ,
+                             memoize=memoize,
+                             refineGames=refineGames,
+                             checkpointInterval=checkpointInterval,
+                             checkpointPrefix=checkpointPrefix)
+        # Set by fromCheckpoint, the next run starts from this (generation, population, evaluations, rng states)
+        self.resume = None
         # Checking to make sure that the given file is not there already
         if self.csvFile is not None:
             open(self.csvFile, 'x').close()
@@ -50,9 +89,69 @@ class GeneticFactory:
                 writer = csv.writer(csvFile)
                 writer.writerow([
                     "Generation", "Max Score", "Total Score", "Average Score",
-                    "Weights", "Time for Generation"
+                    "Weights", "Time for Generation", "Games Per Genome",
+                    "Games Played"
                 ])
 
+    @staticmethod
+    def fromCheckpoint(path):
+        """
+        Rebuilds the factory saved in a checkpoint, the next run continues with the saved population and random state
+        Generations are counted from the start of the original run, so runThreadedSimulation(generations) still stops at the same generation
+        Rows for the new generations are appended to the original csv file
+        """
+        state = readCheckpoint(path)
+        factory = GeneticFactory(state["featureGenerator"],
+                                 **state["settings"])
+        factory.csvFile = state["csvFile"]
+        if state["fitnessStore"] is not None:
+            factory.fitnessStore = state["fitnessStore"]
+        evaluations = None
+        if state["scores"] is not None:
+            evaluations = [(score, weights) for score, weights in zip(
+                state["scores"].tolist(), state["evaluatedWeights"].tolist())]
+        factory.resume = (state["generation"], state["population"].tolist(),
+                          evaluations, state["random"], state["numpyRandom"])
+        return factory
+
+    def startRun(self):
+        """
+        Returns the first generation to run, its population and the evaluations of the generation before it
+        """
+        if self.resume is None:
+            return 0, self.generatePopulation(), None
+        generation, pop, evaluations, randomState, numpyState = self.resume
+        self.resume = None
+        random.setstate(randomState)
+        np.random.set_state(numpyState)
+        return generation, pop, evaluations
+
+    def checkpoint(self, writer, generation, pop, evaluations) -> None:
+        """
+        Saves the run after generation generations are done, if the checkpoint interval is due
+        pop is the population of the next generation and evaluations the ones it was bred from
+        """
+        if not self.checkpointInterval or generation % self.checkpointInterval:
+            return
+        # Weights are stored as float64 matrices, which hold python floats exactly
+        state = dict(version=1,
+                     generation=generation,
+                     settings=self.settings,
+                     featureGenerator=self.featureGenerator,
+                     csvFile=self.csvFile,
+                     population=np.array(pop, dtype=np.float64),
+                     scores=np.array([score for score, _ in evaluations],
+                                     dtype=np.float64),
+                     evaluatedWeights=np.array(
+                         [weights for _, weights in evaluations],
+                         dtype=np.float64),
+                     random=random.getstate(),
+                     numpyRandom=np.random.get_state(),
+                     fitnessStore=self.fitnessStore)
+        path = "{}{}".format(self.checkpointPrefix, generation)
+        writer.save(path, state)
+        self.logger.info("Saving checkpoint {}".format(path))
+
     def generatePopulation(self):
 
         def generateRandomWeights():
@@ -96,34 +195,6 @@ class GeneticFactory:
                 nextGen.append(newMans)
         return nextGen
 
-    def threadedEvaluator(self, queue: Queue, evaluationQueue: Queue):
-        # So this evaluator will constantly be checking for new jobs
-        # and will evaluate them and put them back on the evaluation queue
-        while True:
-            if queue.empty():
-                time.sleep(.5)
-                continue
-            weights = queue.get()
-            # If it is passed false then it will exit
-            if weights == False:
-                break
-            if self.linear:
-                agent = FeatureAgent(self.featureGenerator, weights)
-            else:
-                agent = NetworkAgent(self.featureGenerator, weights)
-            sim = TetrisSimulation(agent, numKnownPieces=1)
-            games = [
-                sim.playGame(scoringType=self.scoring)
-                for _ in range(self.numGames)
-            ]
-            scores = []
-            for game in games:
-                board, score, survived, boards, moves, pieces, linesCleared = game
-                scores.append(score)
-            # Here we are passing back in the weight
-            evaluationQueue.put((sum(scores) / len(scores), weights))
-        print("This Process Is Finished, recieved false from queue")
-
     def runSimulation(self, generations=10):
         pop = self.generatePopulation()
         for i in range(generations):
@@ -142,73 +213,212 @@ class GeneticFactory:
             pop = self.computeNextGeneration(evaluations)
         return sorted(evaluations, key=lambda x: x[0])[-1]
 
-    def runThreadedSimulation(self, generations=10, threads=16):
-        pop = self.generatePopulation()
-        q = Queue()
-        evaluationQueue = Queue()
-        processList: List[Process] = []
-        for j in range(threads):
-            p = Process(target=self.threadedEvaluator,
-                        args=(q, evaluationQueue))
-            p.start()
-            processList.append(p)
-            self.logger.debug("Process {} started".format(j))
+    def logGeneration(self, generation, evaluations, t, gamesPlayed=None):
+        m = max(evaluations, key=lambda x: x[0])
+        self.logger.info("Max Average Score: {}".format(m[0]))
+        self.logger.info("Max Weights: {}".format(m[1]))
+        self.logger.info("Time to run generation: {}".format(t))
+        # Lets go ahead and log some of those rather important stats onto the csv file
+        if self.csvFile is not None:
+            with open(self.csvFile, "a", newline='') as csvFile:
+                writer = csv.writer(csvFile)
+                # lets go ahead and compile some stats about the current generation
+                scores = [x[0] for x in evaluations]
+                maxScore = max(scores)
+                totalScore = sum(scores)
+                avgScore = totalScore / len(scores)
+                mWeights = m[1]
+                # The number of games each genome played in population order, racing and memoized elites make it less than numGames
+                if gamesPlayed is None:
+                    gamesPlayed = [self.numGames] * len(evaluations)
+                games = sum(gamesPlayed) / len(gamesPlayed)
+                writer.writerow([
+                    generation, maxScore, totalScore, avgScore, mWeights, t,
+                    games,
+                    list(gamesPlayed)
+                ])
 
-        for i in range(generations):
-            self.logger.info("Generation {}".format(i))
-            startTime = time.time()
-            # We are using a queue so that we can have multiple processes
-            for weightVector in pop:
-                q.put(weightVector)
+    def evaluatePopulation(self, pop, seeds, chunkSize=1000):
+        """
+        Evaluates a linear population in lockstep on one core, every genome plays the same numGames piece sequences
+        Returns (score, weights) tuples like the threaded evaluator
+        """
+        if not self.linear:
+            raise ValueError(
+                "Only linear populations can be evaluated as one batch")
+        evaluations = []
+        # The population is played chunkSize genomes at a time to bound the size of the feature matrices
+        for start in range(0, len(pop), chunkSize):
+            chunk = pop[start:start + chunkSize]
+            sim = LinearPopulationSimulation(self.featureGenerator,
+                                             chunk,
+                                             numGames=self.numGames,
+                                             seeds=seeds)
+            scores = sim.evaluate(scoringType=self.scoring)
+            evaluations.extend((float(score), weights)
+                               for score, weights in zip(scores, chunk))
+        return evaluations
 
-            evaluations = []
-            while True:
-                if evaluationQueue.empty():
-                    time.sleep(.5)
-                    continue
-                else:
-                    evaluations.append(evaluationQueue.get())
-                self.logger.debug("Current Evaluation Length: {}".format(
-                    len(evaluations)))
-                # If we get to a point where our number of evaluations the same as our population, then we
-                # can stop
-                if len(evaluations) == self.totalPopulation:
-                    break
-            # Doing some logging
-            self.logger.debug("Evaluations Length: {}".format(
-                len(evaluations)))
-            m = max(evaluations, key=lambda x: x[0])
-            self.logger.info("Max Average Score: {}".format(m[0]))
-            self.logger.info("Max Weights: {}".format(m[1]))
-            endtime = time.time()
-            self.logger.info("Time to run generation: {}".format(endtime -
-                                                                 startTime))
-            # Lets go ahead and log some of those rather important stats onto the csv file
-            if self.csvFile is not None:
-                with open(self.csvFile, "a", newline='') as csvFile:
-                    writer = csv.writer(csvFile)
-                    # lets go ahead and compile some stats about the current generation
-                    scores = [x[0] for x in evaluations]
-                    maxScore = max(scores)
-                    totalScore = sum(scores)
-                    avgScore = totalScore / len(scores)
-                    mWeights = m[1]
-                    t = endtime - startTime
-                    writer.writerow(
-                        [i, maxScore, totalScore, avgScore, mWeights, t])
+    def runBatchedSimulation(self, generations=10, chunkSize=1000):
+        start, pop, evaluations = self.startRun()
+        with CheckpointWriter() as writer:
+            for i in range(start, generations):
+                self.logger.info("Generation {}".format(i))
+                startTime = time.time()
+                # Every genome of a generation gets the same pieces, so scores only differ because of the weights
+                seeds = [random.randrange(2**32) for _ in range(self.numGames)]
+                evaluations = self.evaluatePopulation(pop, seeds, chunkSize)
+                self.logGeneration(i, evaluations, time.time() - startTime)
+                pop = self.computeNextGeneration(evaluations)
+                self.checkpoint(writer, i + 1, pop, evaluations)
+        return sorted(evaluations, key=lambda x: x[0])[-1]
 
-            pop = self.computeNextGeneration(evaluations)
+    def raceGeneration(self, scheduler, pop, pieces=None, seeds=None):
+        """
+        Plays the population through the rounds of the racing schedule, without one every genome plays numGames games in one round
+        seeds are the seeds of the shared piece sequences, if any
+        Returns the (average score, weights) evaluations and the number of games each genome played this generation
+        """
+        scores = [[] for _ in pop]
+        newGames = [0] * len(pop)
+        alive = list(range(len(pop)))
+        records = None
+        if self.fitnessStore is not None:
+            records = [
+                self.fitnessStore.record(weightsKey(weights), self.scoring)
+                for weights in pop
+            ]
+            known = [i for i in alive if records[i].numGames >= self.numGames]
+            alive = [i for i in alive if records[i].numGames < self.numGames]
+            if self.refineGames > 0 and known:
+                jobs = [(pop[i], pieces, 0, self.refineGames) for i in known]
+                for index, gameScores in scheduler.map(jobs):
+                    records[known[index]].add_games(gameScores, seeds)
+                    newGames[known[index]] += len(gameScores)
+            # The games known genomes already played race along with the new ones
+            for i in known:
+                scores[i] = list(records[i].scores)
+        raced = list(alive)
+        played = 0
+        for end in self.racingSchedule + (self.numGames, ):
+            # Every genome still racing plays games played..end, the same pieces for all of them with common pieces
+            jobs = [(pop[i], pieces, played, end) for i in alive]
+            # Scores stream back as soon as each chunk of genomes is done
+            for index, gameScores in scheduler.map(jobs):
+                scores[alive[index]].extend(gameScores)
+                newGames[alive[index]] += len(gameScores)
+            played = end
+            if end < self.numGames:
+                alive = self.race(scores, alive)
+                self.logger.debug(
+                    "{} genomes still racing after {} games".format(
+                        len(alive), end))
+        if records is None:
+            evaluations = [(sum(s) / len(s), weights)
+                           for s, weights in zip(scores, pop)]
+            return evaluations, newGames
+        for i in raced:
+            records[i].add_games(scores[i], seeds)
+        evaluations = [(record.mean(), weights)
+                       for record, weights in zip(records, pop)]
+        return evaluations, newGames
 
-        # We want to kill all the processes
-        for j in range(threads):
-            q.put(False)
-        for p in processList:
-            p.join()
+    def race(self, scores, alive) -> list:
+        """
+        Returns the genomes that can still make the top third computeNextGeneration keeps
+        A genome is dropped when its mean plus racingZ standard errors is below the mean minus racingZ standard errors
+        of the last genome that currently makes the cut
+        """
+        means = np.array([np.mean(s) for s in scores])
+        errors = np.array([
+            np.std(s, ddof=1) / np.sqrt(len(s)) if len(s) > 1 else np.inf
+            for s in scores
+        ])
+        keep = max(1, len(scores) // 3)
+        boundary = np.argsort(-means, kind="stable")[keep - 1]
+        cutoff = means[boundary] - self.racingZ * errors[boundary]
+        return [
+            i for i in alive if means[i] + self.racingZ * errors[i] >= cutoff
+        ]
+
+    def runThreadedSimulation(self, generations=10, threads=16):
+        start, pop, evaluations = self.startRun()
+        evaluator = GenomeEvaluator(self.featureGenerator, self.linear,
+                                    self.scoring)
+        # The workers stay up for every generation and keep their agent and simulation between genomes
+        # Checkpoints are written in the background while the next generation runs
+        with WorkScheduler(
+                evaluator,
+                numWorkers=threads) as scheduler, CheckpointWriter() as writer:
+            for i in range(start, generations):
+                self.logger.info("Generation {}".format(i))
+                startTime = time.time()
+                pieces = None
+                seeds = None
+                if self.commonPieces:
+                    # Only the name of the shared block is sent with each genome
+                    seeds = [
+                        random.randrange(2**32) for _ in range(self.numGames)
+                    ]
+                    pieces = SharedPieceSequences.create(seeds)
+                try:
+                    evaluations, gamesPlayed = self.raceGeneration(
+                        scheduler, pop, pieces, seeds)
+                finally:
+                    if pieces is not None:
+                        pieces.unlink()
+                stats = scheduler.stats()
+                self.logger.info(
+                    "Worker utilization: {:.1%}, chunks: {}, speculative: {}".
+                    format(stats["utilization"], stats["chunks"],
+                           stats["speculative"]))
+                self.logger.info("Games played: {} of {}".format(
+                    sum(gamesPlayed),
+                    len(pop) * self.numGames))
+                self.logGeneration(i, evaluations,
+                                   time.time() - startTime, gamesPlayed)
+
+                pop = self.computeNextGeneration(evaluations)
+                self.checkpoint(writer, i + 1, pop, evaluations)
         self.logger.debug("All Threads Successfully Joined")
         # We want to sort the evaluations by score and return the best one
         return sorted(evaluations, key=lambda x: x[0])[-1]
 
 
+class GenomeEvaluator:
+    """
+    Plays the games of one genome at a time inside a worker process
+    Jobs are (weights, pieces, start, end), the genome plays games start to end of the shared piece sequences of the generation,
+    or end - start games with random pieces when pieces is None
+    Returns the score of every game
+    The agent and simulation are built for the first genome and only get new weights after that
+    """
+
+    def __init__(self, featureGenerator, linear, scoring) -> None:
+        self.featureGenerator = featureGenerator
+        self.linear = linear
+        self.scoring = scoring
+        self.sim = None
+
+    def __call__(self, job) -> list:
+        weights, pieces, start, end = job
+        if self.sim is None:
+            if self.linear:
+                agent = FeatureAgent(self.featureGenerator, weights)
+            else:
+                agent = NetworkAgent(self.featureGenerator, weights)
+            # All of the games are played in lockstep so each step scores every game's placements in one batch
+            self.sim = VectorTetrisSimulation(agent,
+                                              numGames=end - start,
+                                              numKnownPieces=1)
+        else:
+            self.sim.agent.set_weights(weights)
+        self.sim.numGames = end - start
+        self.sim.pieceSequences = None if pieces is None else pieces[start:end]
+        games = self.sim.playGames(scoringType=self.scoring)
+        return [float(score) for board, score, survived, linesCleared in games]
+
+
 def trainGeneticAgent(featureGenerator, totalPopulation=1000, generations=10):
     factory = GeneticFactory(featureGenerator, totalPopulation=totalPopulation)
     best_agent = factory.runThreadedSimulation(generations=generations,
@@ -1,5 +1,6 @@
 import numpy as np
 
+from constants import BOARD_WIDTH, BOARD_HEIGHT
 from tetrisClasses import Board, Piece, Move, TetrisPlacementState
 
 
@@ -51,4 +52,147 @@ def featureVector(board: Board, prevBoard: Board):
         (prevBoard.get_num_blocks() + 4 - board.get_num_blocks()) //
         10,  # Equivalent to number of lines cleared
         1 if board.is_lost() else 0,
-    ])
\ No newline at end of file
+    ])
+
+
+# Batched versions of the feature vectors
+# These take every afterstate of a decision at once, either as a list of Boards,
+# an (N, BOARD_HEIGHT) array of row bitmasks or an (N, BOARD_HEIGHT, BOARD_WIDTH) matrix,
+# and return an (N, F) matrix whose rows are exactly what the single board versions return
+# prevBoard is either the Board every afterstate came from, or a list with the previous Board of each row when several games are batched
+
+
+def packBoards(boards: list) -> np.ndarray:
+    """
+    Packs boards into an (N, BOARD_HEIGHT) array of their row bitmasks
+    """
+    return np.array([b.get_rows() for b in boards],
+                    dtype=np.uint16).reshape(-1, BOARD_HEIGHT)
+
+
+def _filledSquares(boards) -> np.ndarray:
+    # Returns an (N, BOARD_HEIGHT, BOARD_WIDTH) boolean array of the filled squares
+    if not isinstance(boards, np.ndarray):
+        boards = packBoards(boards)
+    if boards.ndim == 3:
+        return boards != 0
+    return (
+        boards[:, :, None] >> np.arange(BOARD_WIDTH, dtype=np.uint16)) & 1 != 0
+
+
+def packSquares(boards: list) -> np.ndarray:
+    """
+    Packs boards into an (N, BOARD_HEIGHT, BOARD_WIDTH) uint8 array of what get_square returns
+    """
+    return _withColors(_filledSquares(boards).astype(np.uint8), boards)
+
+
+def _withColors(squares: np.ndarray, boards: list) -> np.ndarray:
+    # Writes the colors of the Boards that have them over their filled squares
+    index = ([], [], [])
+    colors = []
+    for n, b in enumerate(boards):
+        for y, row in enumerate(b.get_colors() or ()):
+            index[0].extend([n] * len(row))
+            index[1].extend([y] * len(row))
+            index[2].extend(row.keys())
+            colors.extend(row.values())
+    squares[index] = colors
+    return squares
+
+
+def _squareValues(boards, filled: np.ndarray) -> np.ndarray:
+    # Returns what get_square returns for every square, the colors of matrices and colored Boards, otherwise just the filled squares
+    if isinstance(boards, np.ndarray):
+        return boards if boards.ndim == 3 else filled
+    if not any(b.has_colors() for b in boards):
+        return filled
+    return _withColors(filled.astype(np.uint8), boards)
+
+
+def _prevNumBlocks(prevBoard):
+    # Number of blocks on the previous board, one per row if every row has its own previous board
+    if isinstance(prevBoard, Board):
+        return prevBoard.get_num_blocks()
+    # Rows of the same game share their previous Board, so each Board is only counted once
+    counts = {}
+    for b in prevBoard:
+        if id(b) not in counts:
+            counts[id(b)] = b.get_num_blocks()
+    return np.array([counts[id(b)] for b in prevBoard])
+
+
+def _columnHeights(filled: np.ndarray) -> np.ndarray:
+    # Same as get_colmn_height, BOARD_HEIGHT for empty columns
+    return np.where(filled.any(axis=1), filled.argmax(axis=1), BOARD_HEIGHT)
+
+
+def _boardFeatures(filled: np.ndarray) -> tuple:
+    heights = _columnHeights(filled)
+    normalizedHeight = BOARD_HEIGHT - heights.min(axis=1)
+    aggregateHeight = (BOARD_HEIGHT - heights).sum(axis=1)
+    # A hole is an empty square with a block somewhere above it
+    covered = np.logical_or.accumulate(filled, axis=1)
+    holes = (covered & ~filled).sum(axis=(1, 2))
+    bumpiness = np.abs(np.diff(heights, axis=1)).sum(axis=1)
+    lost = (normalizedHeight == BOARD_HEIGHT).astype(heights.dtype)
+    return heights, normalizedHeight, aggregateHeight, holes, bumpiness, lost
+
+
+def originalFeatureMatrix(boards, prevBoard: Board = None) -> np.ndarray:
+    filled = _filledSquares(boards)
+    _, normalizedHeight, aggregateHeight, holes, bumpiness, lost = _boardFeatures(
+        filled)
+    return np.stack(
+        [normalizedHeight, aggregateHeight, holes, bumpiness, lost], axis=1)
+
+
+def featureMatrix(boards, prevBoard: Board) -> np.ndarray:
+    filled = _filledSquares(boards)
+    heights, normalizedHeight, aggregateHeight, holes, bumpiness, lost = _boardFeatures(
+        filled)
+    # Transitions compare the squares like get_square does, so colored boards also count changes between colors
+    squares = _squareValues(boards, filled)
+    rowTransitions = (squares[:, 1:, :] != squares[:, :-1, :]).sum(axis=(1, 2))
+    # Same indexing as Board.get_num_column_transitions, horizontal changes in the top rows plus one for the right wall
+    top = squares[:, :BOARD_WIDTH, :]
+    columnTransitions = (top[:, :, 1:]
+                         != top[:, :, :-1]).sum(axis=(1, 2)) + top.shape[1]
+    pits = (heights == BOARD_HEIGHT).sum(axis=1)
+    linesCleared = (_prevNumBlocks(prevBoard) + 4 -
+                    filled.sum(axis=(1, 2))) // 10
+    return np.stack([
+        normalizedHeight, aggregateHeight, holes, bumpiness, rowTransitions,
+        columnTransitions, pits, linesCleared, lost
+    ],
+                    axis=1)
+
+
+BATCH_FEATURE_GENERATORS = {
+    featureVector: featureMatrix,
+    originalFeatureVector: originalFeatureMatrix,
+}
+
+
+def getFeatureMatrixGenerator(featureVectorGenerator):
+    """
+    Returns the batched version of a feature vector generator
+    Generators without one are simply called once per board
+    """
+    if featureVectorGenerator in BATCH_FEATURE_GENERATORS:
+        return BATCH_FEATURE_GENERATORS[featureVectorGenerator]
+
+    def stackedFeatureMatrix(boards, prevBoard: Board) -> np.ndarray:
+        if isinstance(boards, np.ndarray):
+            boards = [
+                Board(b.tolist())
+                if boards.ndim == 3 else Board.from_rows(b.tolist())
+                for b in boards
+            ]
+        if isinstance(prevBoard, Board):
+            return np.array(
+                [featureVectorGenerator(b, prevBoard) for b in boards])
+        return np.array(
+            [featureVectorGenerator(b, p) for b, p in zip(boards, prevBoard)])
+
+    return stackedFeatureMatrix
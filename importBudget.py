@@ -0,0 +1,73 @@
+"""
+Measures how long each module takes to import in a fresh interpreter and how much memory the interpreter ends up using
+Every worker process pays this before it plays a single piece, so the engine modules have a budget and must not load any heavyweight backend
+Run with python importBudget.py [modules...], it exits with an error if anything goes over budget
+"""
+import json
+import subprocess
+import sys
+
+# Seconds each module is allowed to take to import, numpy is most of it
+IMPORT_BUDGETS = {
+    "constants": 0.05,
+    "piece": 0.1,
+    "tetrisClasses": 0.1,
+    "tetrisPieceGenerator": 0.1,
+    "transpositionTable": 0.05,
+    "hueristics": 0.5,
+    "tetrisUtilities": 0.5,
+    "tetrisAgent": 0.5,
+    "tetrisSimulation": 0.5,
+    "geneticFactory": 1.0,
+}
+# None of the budgeted modules are allowed to import these, they get loaded when an agent that needs them is built
+HEAVY_MODULES = ("tensorflow", "keras", "neat", "tkinter", "pygame")
+
+MEASURE_SCRIPT = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "maxRssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "heavy": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def measureImport(module: str) -> dict:
+    """
+    Imports the module in a fresh interpreter and returns its import time, peak memory and the heavyweight modules it loaded
+    """
+    result = subprocess.run(
+        [
+            sys.executable, "-c",
+            MEASURE_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(modules=None) -> bool:
+    modules = modules or list(IMPORT_BUDGETS)
+    allGood = True
+    print(
+        f"{'Module':<22}{'Seconds':>9}{'Budget':>9}{'Max RSS MB':>12}  Heavy")
+    for module in modules:
+        m = measureImport(module)
+        budget = IMPORT_BUDGETS.get(module)
+        overBudget = budget is not None and m["seconds"] > budget
+        allGood = allGood and not overBudget and not m["heavy"]
+        print(
+            f"{module:<22}{m['seconds']:>9.3f}{budget if budget is not None else '-':>9}{m['maxRssKb'] / 1024:>12.1f}  {','.join(m['heavy'])}{'  OVER BUDGET' if overBudget else ''}"
+        )
+    return allGood
+
+
+if __name__ == "__main__":
+    if not main(sys.argv[1:]):
+        sys.exit(1)
@@ -0,0 +1,176 @@
+import numpy as np
+
+# Value columns every compiled network has, unused link slots read one of these so padding never changes a result
+ZERO_SLOT = 0
+ONE_SLOT = 1
+
+
+def vectorizedActivations() -> dict:
+    """
+    NumPy versions of the neat activations that give exactly the same floats as the scalar ones
+    Any other activation (sigmoid, tanh, selu...) is called once per element instead, since np.exp does not always round like math.exp
+    """
+    from neat import activations
+    return {
+        activations.identity_activation:
+        lambda z: z,
+        activations.relu_activation:
+        lambda z: np.where(z > 0.0, z, 0.0),
+        activations.abs_activation:
+        np.abs,
+        activations.clamped_activation:
+        lambda z: np.maximum(-1.0, np.minimum(1.0, z)),
+    }
+
+
+def vectorizedAggregations() -> dict:
+    """
+    Maps the neat aggregations that can be done as a running total to (padding slot, starting total, update)
+    """
+    from neat import aggregations
+    return {
+        aggregations.sum_aggregation: (ZERO_SLOT, 0.0, np.add),
+        aggregations.product_aggregation: (ONE_SLOT, 1.0, np.multiply),
+    }
+
+
+class CompiledLayer:
+    """
+    All the nodes of a network whose inputs are ready at the same time
+    Nodes with an aggregation that can be vectorized are done together, one link at a time in the order neat sums them
+    The rest are done one node and one row at a time with the original aggregation function
+    """
+
+    def __init__(self, nodes, slots, aggregations, activations) -> None:
+        # nodes are (slot, node eval) pairs, all links have already been turned into value slots
+        self.groups = []
+        self.fallback = []
+        grouped = {}
+        for slot, (_, act, agg, bias, response, links) in nodes:
+            if agg in aggregations:
+                grouped.setdefault(agg, []).append(
+                    (slot, act, bias, response, links))
+            else:
+                self.fallback.append((slot, act, agg, bias, response,
+                                      np.array([slots[i] for i, _ in links],
+                                               dtype=np.intp),
+                                      np.array([w for _, w in links],
+                                               dtype=float)))
+        for agg, group in grouped.items():
+            padSlot, start, update = aggregations[agg]
+            # Unused links read the padding slot with a weight of 1, adding 0 or multiplying by 1 leaves the total as is
+            numLinks = max(len(links) for _, _, _, _, links in group)
+            sources = np.full((numLinks, len(group)), padSlot, dtype=np.intp)
+            weights = np.ones((numLinks, len(group)))
+            for j, (_, _, _, _, links) in enumerate(group):
+                for k, (i, w) in enumerate(links):
+                    sources[k, j] = slots[i]
+                    weights[k, j] = w
+            targets = np.array([slot for slot, *_ in group], dtype=np.intp)
+            bias = np.array([b for _, _, b, _, _ in group], dtype=float)
+            response = np.array([r for _, _, _, r, _ in group], dtype=float)
+            self.groups.append(
+                (start, update, sources, weights, targets, bias, response,
+                 activationGroups([act for _, act, *_ in group], activations)))
+
+    def __call__(self, values) -> None:
+        for start, update, sources, weights, targets, bias, response, acts in self.groups:
+            total = np.full((len(values), len(targets)), start)
+            for k in range(len(sources)):
+                total = update(total, values[:, sources[k]] * weights[k])
+            z = bias + response * total
+            for columns, act in acts:
+                values[:, targets[columns]] = act(z[:, columns])
+        for slot, act, agg, bias, response, sources, weights in self.fallback:
+            products = values[:, sources] * weights
+            values[:, slot] = [
+                act(bias + response * agg(list(row))) for row in products
+            ]
+
+
+def activationGroups(acts, activations) -> list:
+    """
+    Splits the columns of a layer by activation, returns (columns, vectorized activation) pairs
+    """
+    columns = {}
+    for j, act in enumerate(acts):
+        columns.setdefault(act, []).append(j)
+    groups = []
+    for act, cols in columns.items():
+        vectorized = activations.get(act)
+        if vectorized is None:
+            scalar = np.frompyfunc(act, 1, 1)
+            vectorized = lambda z, scalar=scalar: scalar(z).astype(float)
+        groups.append((np.array(cols, dtype=np.intp), vectorized))
+    return groups
+
+
+class CompiledNetwork:
+    """
+    A neat FeedForwardNetwork compiled into layers of NumPy operations so a whole batch of inputs goes through in one call
+    Gives exactly the same outputs as FeedForwardNetwork.activate, every sum is done in the same order with the same floats
+    """
+
+    def __init__(self, inputNodes, outputNodes, nodeEvals) -> None:
+        self.input_nodes = list(inputNodes)
+        self.output_nodes = list(outputNodes)
+        # Every input, output and evaluated node gets a column in the value matrix, after the two constant columns
+        slots = {}
+        for node in self.input_nodes + self.output_nodes + [
+                n[0] for n in nodeEvals
+        ]:
+            slots.setdefault(node, len(slots) + 2)
+        self.numSlots = len(slots) + 2
+        self.inputSlots = np.array([slots[n] for n in self.input_nodes],
+                                   dtype=np.intp)
+        self.outputSlots = np.array([slots[n] for n in self.output_nodes],
+                                    dtype=np.intp)
+        # A node goes in the layer after the last of the nodes it reads from, inputs and constants are layer 0
+        depth = {}
+        layers = []
+        for nodeEval in nodeEvals:
+            node, links = nodeEval[0], nodeEval[5]
+            d = 1 + max((depth.get(i, 0) for i, _ in links), default=0)
+            depth[node] = d
+            while len(layers) < d:
+                layers.append([])
+            layers[d - 1].append((slots[node], nodeEval))
+        aggregations = vectorizedAggregations()
+        activations = vectorizedActivations()
+        self.layers = [
+            CompiledLayer(nodes, slots, aggregations, activations)
+            for nodes in layers
+        ]
+
+    @staticmethod
+    def create(genome, config):
+        """
+        Compiles a genome the same way neat.nn.FeedForwardNetwork.create builds it
+        """
+        import neat
+        return CompiledNetwork.from_network(
+            neat.nn.FeedForwardNetwork.create(genome, config))
+
+    @staticmethod
+    def from_network(network):
+        return CompiledNetwork(network.input_nodes, network.output_nodes,
+                               network.node_evals)
+
+    def activate_batch(self, inputs) -> np.ndarray:
+        """
+        Takes an (N, number of inputs) matrix and returns the (N, number of outputs) outputs
+        """
+        inputs = np.asarray(inputs, dtype=float)
+        if inputs.ndim != 2 or inputs.shape[1] != len(self.inputSlots):
+            raise RuntimeError(
+                f"Expected {len(self.inputSlots)} inputs, got {inputs.shape[-1]}"
+            )
+        values = np.zeros((len(inputs), self.numSlots))
+        values[:, ONE_SLOT] = 1.0
+        values[:, self.inputSlots] = inputs
+        for layer in self.layers:
+            layer(values)
+        return values[:, self.outputSlots]
+
+    def activate(self, inputs) -> list:
+        return self.activate_batch([inputs])[0].tolist()
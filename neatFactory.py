@@ -1,12 +1,17 @@
 from __future__ import print_function
 import csv
 import os
+import random
 import neat
 import math
 import time
 
+from neatCompiler import CompiledNetwork
 from tetrisAgent import NeatAgent
-from tetrisSimulation import TetrisSimulation
+from tetrisSimulation import TetrisSimulation, VectorTetrisSimulation
+from pieceSequences import SharedPieceSequences
+from fitnessStore import FitnessStore, genomeKey
+from workScheduler import WorkScheduler
 from hueristics import featureVector
 
 NUM_GAMES = 10
@@ -18,26 +23,126 @@ def selu_activation(z):
     return lam * z if z > 0.0 else lam * alpha * (math.exp(z) - 1)
 
 
-def eval_single_genome(genome, config):
+def eval_single_genome(genome, config, pieces=None):
+    # pieces are the piece sequences shared by every genome of the generation, without them each game gets random pieces
     total = 0
-    net = neat.nn.FeedForwardNetwork.create(genome, config)
-    for _ in range(NUM_GAMES):
-        agent = NeatAgent(featureVector, net)
-        sim = TetrisSimulation(agent)
-        board, score, survived, boards, moves, pieces, linesCleared = sim.playGame(
-            scoringType='tetris')
+    net = CompiledNetwork.create(genome, config)
+    agent = NeatAgent(featureVector, net)
+    # The games are played in lockstep, every step runs all of their placements through the network at once
+    sim = VectorTetrisSimulation(agent,
+                                 numGames=NUM_GAMES,
+                                 pieceSequences=pieces)
+    for board, score, survived, linesCleared in sim.playGames(
+            scoringType='tetris'):
         total += score
     total /= NUM_GAMES
     # print("Finished Evaluating Genome")
     return total
 
 
-def eval_genomes(genomes, config):
-    evaluator = neat.ParallelEvaluator(16, eval_single_genome)
-    evaluator.evaluate(genomes, config)
-
-
-def run(config_file, checkpoint_file: str = None, csv_file=None):
+class GenomeEvaluator:
+    """
+    Plays the games of one neat genome at a time inside a worker process
+    Jobs are (genome, pieces), the genome plays the shared piece sequences of the generation, or random pieces when pieces is None
+    Returns the score of every game
+    The agent and simulation are built once when the worker starts, each genome only swaps in its compiled network
+    """
+
+    def __init__(self, config, numGames=NUM_GAMES, scoring='tetris') -> None:
+        self.config = config
+        self.numGames = numGames
+        self.scoring = scoring
+        self.sim = None
+
+    def warm(self) -> None:
+        if self.sim is None:
+            agent = NeatAgent(featureVector, None)
+            self.sim = VectorTetrisSimulation(agent, numGames=self.numGames)
+
+    def __call__(self, job) -> list:
+        genome, pieces = job
+        self.warm()
+        self.sim.agent.network = CompiledNetwork.create(genome, self.config)
+        self.sim.pieceSequences = pieces
+        games = self.sim.playGames(scoringType=self.scoring)
+        return [float(score) for board, score, survived, linesCleared in games]
+
+
+class NeatEvaluator:
+    """
+    Replaces neat.ParallelEvaluator with one pool of workers that is kept for the whole run, pass evaluate to Population.run
+    Genomes are handed out in guided chunks
+    With commonPieces every genome of a generation plays the same piece sequences, read from shared memory
+    With memoize genomes that come through elitism unchanged keep their fitness instead of being replayed,
+    the fitness of every genome this evaluator has seen is kept in its own FitnessStore
+    """
+
+    def __init__(self,
+                 config,
+                 numWorkers=16,
+                 minChunk=1,
+                 chunkDivisor=2,
+                 numGames=NUM_GAMES,
+                 scoring='tetris',
+                 commonPieces=False,
+                 memoize=False) -> None:
+        self.numGames = numGames
+        self.scoring = scoring
+        self.commonPieces = commonPieces
+        self.store = FitnessStore() if memoize else None
+        evaluator = GenomeEvaluator(config, numGames, scoring)
+        self.scheduler = WorkScheduler(evaluator,
+                                       numWorkers=numWorkers,
+                                       minChunk=minChunk,
+                                       chunkDivisor=chunkDivisor,
+                                       initializer=evaluator.warm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def evaluate(self, genomes, config) -> None:
+        unknown = []
+        for genome_id, genome in genomes:
+            if self.store is None:
+                unknown.append((None, genome))
+                continue
+            key = genomeKey(genome)
+            record = self.store.get(key, self.scoring)
+            if record is not None and record.numGames >= self.numGames:
+                genome.fitness = record.mean()
+            else:
+                unknown.append((key, genome))
+        seeds = None
+        pieces = None
+        if self.commonPieces:
+            # Only the name of the shared block is sent with each genome
+            seeds = [random.randrange(2**32) for _ in range(self.numGames)]
+            pieces = SharedPieceSequences.create(seeds)
+        try:
+            jobs = [(genome, pieces) for _, genome in unknown]
+            for index, scores in self.scheduler.map(jobs):
+                key, genome = unknown[index]
+                genome.fitness = sum(scores) / len(scores)
+                if self.store is not None:
+                    self.store.record(key,
+                                      self.scoring).add_games(scores, seeds)
+        finally:
+            if pieces is not None:
+                pieces.unlink()
+
+    def close(self) -> None:
+        self.scheduler.close()
+
+
+def run(config_file,
+        checkpoint_file: str = None,
+        csv_file=None,
+        numWorkers=16,
+        commonPieces=False,
+        memoize=False):
     # Load configuration.
     config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction,
                          neat.DefaultSpeciesSet, neat.DefaultStagnation,
@@ -61,7 +166,12 @@ def run(config_file, checkpoint_file: str = None, csv_file=None):
     #     neat.Checkpointer(5, filename_prefix='neat-checkpoints/selu-'))
 
     # Run for up to 300 generations.
-    winner = p.run(eval_genomes, 5)
+    # The workers stay up for every generation and keep their agent and simulation between genomes
+    with NeatEvaluator(config,
+                       numWorkers=numWorkers,
+                       commonPieces=commonPieces,
+                       memoize=memoize) as evaluator:
+        winner = p.run(evaluator.evaluate, 5)
 
     if csv_file is not None:
         with open(csv_file, 'w') as f:
@@ -79,12 +189,12 @@ def run(config_file, checkpoint_file: str = None, csv_file=None):
 
     # Show output of the most fit genome against training data.
     print("Lets see how it does in 20 games")
-    winner_net = neat.nn.FeedForwardNetwork.create(winner, config)
+    winner_net = CompiledNetwork.create(winner, config)
     for i in range(20):
         agent = NeatAgent(featureVector, winner_net)
         sim = TetrisSimulation(agent)
         board, score, survived, boards, moves, pieces, linesCleared = sim.playGame(
-            scoringType='tetris')
+            scoringType='tetris', record='none')
         print("Game {}: Score: {}".format(i, score))
         print("Game {}: Lines Cleared: {}".format(i, linesCleared))
         print("Game {}: Survived: {}".format(i, survived))
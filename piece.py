@@ -6,7 +6,7 @@
 # Each piece has a different way of rotating (this is important because they don't all rotate around the same point)
 # Because i'm not fucking crazy I am going to use a python dataclass for this
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import random
 from constants import BOARD_WIDTH
 
@@ -14,6 +14,23 @@ from constants import BOARD_WIDTH
 @dataclass(frozen=True)
 class Rotation:
     matrix: tuple  # At its base value, a rotation is a 4x4 matrix of booleans in order to make it hashable we are using tuples
+    # Everything below is derived from the matrix once at import time so placement code never has to loop over the 4x4 matrix
+    # (x offset, y offset) of the 4 blocks
+    cells: tuple = field(init=False, repr=False, compare=False)
+    # The matrix columns, as returned by get_column
+    columns: tuple = field(init=False, repr=False, compare=False)
+    # Each row of the matrix as a bitmask, bit i being column i (same layout as the board rows)
+    rowMasks: tuple = field(init=False, repr=False, compare=False)
+    # (row offset, shifted row mask) pairs of the non empty rows, for every x the piece can be at
+    placementMasks: dict = field(init=False, repr=False, compare=False)
+    # (column offset, offset of the top block, number of blocks) for every non empty column
+    columnSpans: tuple = field(init=False, repr=False, compare=False)
+    # (column offset, offset of the bottom block) for every non empty column
+    bottomContour: tuple = field(init=False, repr=False, compare=False)
+    furthestLeft: int = field(init=False, repr=False, compare=False)
+    furthestRight: int = field(init=False, repr=False, compare=False)
+    # Legal x values are range(*xRange)
+    xRange: tuple = field(init=False, repr=False, compare=False)
 
     # Here we are dealing with the requirements for a rotation
     def __post_init__(self):
@@ -26,31 +43,67 @@ class Rotation:
             blocks += sum(row)  # This also checks typing
         if blocks != 4:
             raise ValueError("Rotation does not have 4 blocks")
+        # The dataclass is frozen so the derived tables have to be set this way
+        setTable = lambda name, value: object.__setattr__(self, name, value)
+        setTable(
+            "cells",
+            tuple((x, y) for y, row in enumerate(self.matrix)
+                  for x, filled in enumerate(row) if filled))
+        setTable(
+            "columns",
+            tuple(tuple(row[col] for row in self.matrix) for col in range(4)))
+        rowMasks = tuple(
+            sum(1 << x for x, filled in enumerate(row) if filled)
+            for row in self.matrix)
+        setTable("rowMasks", rowMasks)
+        setTable(
+            "placementMasks", {
+                x:
+                tuple((yOff, m << x if x >= 0 else m >> -x)
+                      for yOff, m in enumerate(rowMasks) if m)
+                for x in range(-3, BOARD_WIDTH)
+            })
+        columnSpans = []
+        for col, column in enumerate(self.columns):
+            if any(column):
+                columnSpans.append((col, column.index(True), sum(column)))
+        setTable("columnSpans", tuple(columnSpans))
+        setTable(
+            "bottomContour",
+            tuple((col, top + numBlocks - 1)
+                  for col, top, numBlocks in columnSpans))
+        setTable("furthestLeft", columnSpans[0][0])
+        setTable("furthestRight", columnSpans[-1][0])
+        setTable("xRange",
+                 (0 - self.furthestLeft, BOARD_WIDTH - self.furthestRight))
 
     def get_row(self, row: int) -> tuple:
         return self.matrix[row]
 
     def get_column(self, column: int) -> tuple:
-        return tuple(row[column] for row in self.matrix)
+        return self.columns[column]
 
     def get_pos(self, x: int, y: int) -> bool:
         return self.matrix[y][x]
 
-    # These two functions could probably be stored somewhere so that they do not need to be recalculated every time
-    # Not sure if @cache solves this
     def get_furthest_left(self) -> int:
-        for col in range(4):
-            if any(self.get_column(col)):
-                return col
+        return self.furthestLeft
 
     def get_furthest_right(self) -> int:
-        for col in range(3, -1, -1):
-            if any(self.get_column(col)):
-                return col
+        return self.furthestRight
 
     def get_width_range(self) -> tuple:
-        return 0 - self.get_furthest_left(
-        ), BOARD_WIDTH - self.get_furthest_right()
+        return self.xRange
+
+    def get_shape(self) -> tuple:
+        """
+        Returns the blocks shifted so the top left of their bounding box is at 0,0, and the shift that was applied
+        Two rotations with the same shape place the exact same blocks, just from a different x and y
+        """
+        top = min(y for _, y in self.cells)
+        shape = frozenset(
+            (x - self.furthestLeft, y - top) for x, y in self.cells)
+        return shape, (self.furthestLeft, top)
 
 
 # Pieces need to be hashable, this means they cannot govern their own rotation
@@ -60,13 +113,31 @@ class Piece:
     color: str
     rotations: tuple  # we store exactly 4 rotations for every shape
     number: int
+    # Indexes of the rotations that are not geometric duplicates of an earlier one
+    uniqueRotations: tuple = field(init=False, repr=False, compare=False)
+    # For every rotation, (index of the rotation it duplicates, x shift, y shift)
+    # Placing rotation r at x, y places the same blocks as placing duplicateOf[r][0] at x + x shift, y + y shift
+    duplicateOf: tuple = field(init=False, repr=False, compare=False)
 
     #TODO: Right now we are forcing all pieces to have 4 rotations, this is not particularly optimal
-    def __post__init__(self) -> None:
+    def __post_init__(self) -> None:
         # make sure there are exactly 4 rotations
         if len(self.rotations) != 4:
             raise ValueError(
                 f"Piece ({self.name}) must have exactly 4 rotations")
+        shapes = {}
+        uniqueRotations = []
+        duplicateOf = []
+        for i, rot in enumerate(self.rotations):
+            shape, (left, top) = rot.get_shape()
+            if shape not in shapes:
+                shapes[shape] = (i, left, top)
+                uniqueRotations.append(i)
+            original, originalLeft, originalTop = shapes[shape]
+            duplicateOf.append(
+                (original, left - originalLeft, top - originalTop))
+        object.__setattr__(self, "uniqueRotations", tuple(uniqueRotations))
+        object.__setattr__(self, "duplicateOf", tuple(duplicateOf))
 
     def get_rotation(self, num) -> Rotation:
         if num < 0 or num > 3:
@@ -0,0 +1,89 @@
+from __future__ import annotations
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from tetrisPieceGenerator import TetrisPieceGenerator, SequencePieceGenerator
+
+# Enough pieces for a 300 move game with up to 3 known pieces, plus a spare bag
+SEQUENCE_LENGTH = 310
+
+
+def materializePieces(seed, length=SEQUENCE_LENGTH) -> np.ndarray:
+    """
+    Returns the first length pieces of the seeded generator as a uint8 array of piece numbers
+    """
+    gen = TetrisPieceGenerator(seed)
+    return np.fromiter((next(gen).number for _ in range(length)),
+                       dtype=np.uint8,
+                       count=length)
+
+
+# Shared memory blocks this process has attached to, by name
+_attached = {}
+
+
+def attachBlock(name: str) -> shared_memory.SharedMemory:
+    shm = _attached.get(name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+        # Blocks from earlier generations are closed once no game is reading from them anymore
+        for old in [n for n in _attached if n != name]:
+            try:
+                _attached[old].close()
+                del _attached[old]
+            except BufferError:
+                pass
+    return shm
+
+
+class SharedPieceSequences:
+    """
+    K piece sequences stored as a (K, length) uint8 array in shared memory
+    Pickling only sends the name of the block, so every worker reads the same pieces without copying them
+    The process that created the sequences unlinks them when it is done with them
+    """
+
+    def __init__(self, name: str, shape: tuple, shm=None) -> None:
+        self.name = name
+        self.shape = shape
+        self.owner = shm is not None
+        self.shm = shm if shm is not None else attachBlock(name)
+        self.array = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    @classmethod
+    def create(cls, seeds, length=SEQUENCE_LENGTH) -> SharedPieceSequences:
+        sequences = np.stack(
+            [materializePieces(seed, length) for seed in seeds])
+        shm = shared_memory.SharedMemory(create=True, size=sequences.nbytes)
+        shared = cls(shm.name, sequences.shape, shm)
+        shared.array[:] = sequences
+        return shared
+
+    def __reduce__(self):
+        return (SharedPieceSequences, (self.name, self.shape))
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, i) -> np.ndarray:
+        return self.array[i]
+
+    def generators(self) -> list:
+        return [SequencePieceGenerator(sequence) for sequence in self.array]
+
+    def unlink(self) -> None:
+        """
+        Frees the block, only the creating process should call this once the workers are done with it
+        """
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.owner:
+            self.unlink()
@@ -1,12 +1,15 @@
 import pygame
 import pygame as pg
+import os
 import pickle
 import neat
 from pygame.locals import QUIT, KEYDOWN, K_ESCAPE, K_LEFT, K_RIGHT, K_UP, K_DOWN
 
 from myLogger import getModuleLogger
+from neatCompiler import CompiledNetwork
 from tetrisAgent import NeatAgent
 from tetrisSimulation import TetrisSimulation
+from replay import Replay, saveReplay
 from hueristics import featureVector
 from constants import BOARD_HEIGHT, BOARD_WIDTH
 from tetrisClasses import Board, Piece, Move, TetrisPlacementState
@@ -23,7 +26,7 @@ colors = {
 }
 
 
-def getBoardsFromNeatAgent(genomePickleFile: str):
+def loadNeatAgent(genomePickleFile: str) -> NeatAgent:
     # Load Genome from file using pickle
     with open(genomePickleFile, "rb") as f:
         genome = pickle.load(f)
@@ -31,10 +34,14 @@ def getBoardsFromNeatAgent(genomePickleFile: str):
     config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction,
                          neat.DefaultSpeciesSet, neat.DefaultStagnation,
                          "tetrisagentconfig")
-    net = neat.nn.FeedForwardNetwork.create(genome, config)
+    net = CompiledNetwork.create(genome, config)
+    return NeatAgent(featureVector, net)
+
+
+def getBoardsFromNeatAgent(genomePickleFile: str):
+    agent = loadNeatAgent(genomePickleFile)
     logger = getModuleLogger(__name__)
     logger.info("Testing neat agent")
-    agent = NeatAgent(featureVector, net)
     sim = TetrisSimulation(agent)
     # Play a game from simulation
     board, score, survived, boards, moves, pieces, linesCleared = sim.playGame(
@@ -45,21 +52,81 @@ def getBoardsFromNeatAgent(genomePickleFile: str):
     return boards, moves, pieces
 
 
-def playAnimation(boards, moves, pieces, delay=.005):
+def recordNeatAgent(genomePickleFile: str, replayFile: str, seed=0):
+    """
+    Plays one game with the agent and saves it as a replay, the game only keeps its moves while it is played
+    """
+    agent = loadNeatAgent(genomePickleFile)
+    sim = TetrisSimulation(agent, seed=seed)
+    board, score, survived, boards, record, pieces, linesCleared = sim.playGame(
+        scoringType="lines", record="compact")
+    saveReplay(replayFile,
+               record,
+               seed=seed,
+               agentId=os.path.basename(genomePickleFile)[:32],
+               score=score,
+               linesCleared=linesCleared)
+
+
+def playReplay(replayFile: str, start=0, delay=.005):
+    """
+    Animates a replay file from move start on, the boards are rebuilt from the file as they are needed
+    """
+    with Replay(replayFile) as replay:
+        playAnimation(replay.steps(start), delay, replay.board(start))
+
+
+def watchAgent(agent, seed=None, max_moves=10**9, delay=.005):
+    """
+    Animates the agent while it plays, each piece is only chosen once the one before it has landed
+    """
+    sim = TetrisSimulation(agent, seed=seed)
+    playAnimation(sim.steps(max_moves), delay)
+
+
+def animationFrames(steps, board: Board):
+    """
+    Yields (board, falling piece, x, y, rotation) for every frame, the piece drops one row per frame onto the board
+    Frames without a falling piece (piece is None) show a board after a piece landed
+    """
+    for step in steps:
+        move = step.move
+        for y in range(0, move.y):
+            yield board, step.piece, move.x, y, move.rotation
+        board = step.board
+        yield board, None, 0, 0, 0
+
+
+def drawFrame(screen, board: Board, piece, pieceX, pieceY, rotation) -> None:
+    for y in range(BOARD_HEIGHT):
+        for x in range(BOARD_WIDTH):
+            val = board.get_square(x, y)
+            pg.draw.rect(screen, colors[val],
+                         pg.Rect(x * 20 + 50, y * 20 + 50, 20, 20))
+    if piece is not None:
+        # The falling piece is drawn over the board instead of being placed on a new board every frame
+        for x, y in piece.get_rotation(rotation).cells:
+            if pieceY + y >= 0:
+                pg.draw.rect(
+                    screen, colors[piece.number],
+                    pg.Rect((pieceX + x) * 20 + 50, (pieceY + y) * 20 + 50, 20,
+                            20))
+
+
+def playAnimation(steps, delay=.005, startBoard=None):
+    """
+    Animates an iterable of GameSteps, like TetrisSimulation.steps or Replay.steps, as it is consumed
+    Once the steps run out the last board stays on screen until the window is closed
+    """
     pg.init()
     SCREENRECT = pg.Rect(0, 0, 640, 480)
     screen = pg.display.set_mode(SCREENRECT.size)
     pg.display.set_caption("Tetris Game")
     clock = pg.time.Clock()
-    frames = []
-    prevBoard = Board()
-    for b, m, p in zip(boards, moves, pieces):
-        for i in range(0, m.y + 1):
-            frames.append(prevBoard.make_move(p, Move(m.x, i, m.rotation))[0])
-        prevBoard = b
+    frame = (Board() if startBoard is None else startBoard, None, 0, 0, 0)
+    frames = animationFrames(steps, frame[0])
 
     # Run our main loop whilst the player is alive.
-    index = 0
     c = True
     while c:
         # get input
@@ -68,23 +135,19 @@ def playAnimation(boards, moves, pieces, delay=.005):
                 c = False
             if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
                 c = False
-        b: Board = frames[index]
-        for y in range(BOARD_HEIGHT):
-            for x in range(BOARD_WIDTH):
-                val = b.get_square(x, y)
-                pg.draw.rect(screen, colors[val],
-                             pg.Rect(x * 20 + 50, y * 20 + 50, 20, 20))
+        frame = next(frames, frame)
+        drawFrame(screen, *frame)
         # draw the screen
         pg.display.flip()
         pygame.time.delay(int(delay * 1000))
-        index += 1
     pg.quit()
 
 
 def main():
-    boards, moves, pieces = getBoardsFromNeatAgent("neat-agent-95-10x10.pkl")
-    print(len(boards))
-    playAnimation(boards, moves, pieces)
+    replayFile = "neat-agent-95-10x10.replay"
+    if not os.path.exists(replayFile):
+        recordNeatAgent("neat-agent-95-10x10.pkl", replayFile)
+    playReplay(replayFile)
 
 
 if __name__ == "__main__":
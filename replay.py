@@ -0,0 +1,174 @@
+import mmap
+import struct
+
+import numpy as np
+
+from checkpointWriter import writeAtomic
+from constants import BOARD_HEIGHT, BOARD_WIDTH
+from gameRecord import GameRecord, GameStep, decodeStep
+from tetrisClasses import Board
+
+# Replay files are little endian:
+# a HEADER_SIZE byte header, then one uint16 per step encoded like GameRecord,
+# then every keyframeInterval steps a keyframe of the board after that step,
+# its BOARD_HEIGHT uint16 row bitmasks followed by a BOARD_HEIGHT x BOARD_WIDTH uint8 color matrix when colors are kept
+MAGIC = b"TRPL"
+VERSION = 1
+# magic, version, flags, keyframe interval, steps, keyframes, score, lines cleared, seed, agent id
+HEADER = struct.Struct("<4sHHIIIIIQ32s")
+HEADER_SIZE = 96
+FLAG_COLORS = 1
+FLAG_SEED = 2
+KEYFRAME_INTERVAL = 1024
+
+
+def saveReplay(path,
+               record: GameRecord,
+               seed=None,
+               agentId="",
+               score=0,
+               linesCleared=0,
+               keyframeInterval=KEYFRAME_INTERVAL,
+               trackColors=True) -> None:
+    """
+    Writes the game in record to a replay file, the keyframes are made by replaying it once
+    """
+    agentBytes = agentId.encode()
+    if len(agentBytes) > 32:
+        raise ValueError("Agent id must be at most 32 bytes")
+    flags = (FLAG_COLORS if trackColors else 0) | (FLAG_SEED
+                                                   if seed is not None else 0)
+    rows = []
+    colors = []
+    for i, board in enumerate(record.boards(trackColors), 1):
+        if i % keyframeInterval == 0:
+            rows.append(board.get_rows())
+            if trackColors:
+                colors.append(
+                    [[board.get_square(x, y) for x in range(BOARD_WIDTH)]
+                     for y in range(BOARD_HEIGHT)])
+    header = HEADER.pack(MAGIC, VERSION, flags, keyframeInterval, len(record),
+                         len(rows), score, linesCleared,
+                         0 if seed is None else seed, agentBytes)
+    parts = [
+        header.ljust(HEADER_SIZE, b"\0"),
+        np.asarray(record.steps, dtype="<u2").tobytes(),
+        np.asarray(rows, dtype="<u2").tobytes()
+    ]
+    if trackColors:
+        parts.append(np.asarray(colors, dtype=np.uint8).tobytes())
+    writeAtomic(path, b"".join(parts))
+
+
+class Replay:
+    """
+    A replay file opened as a memory map, nothing is read until it is used
+    replay[i] is the (piece, move) of step i and board(i) is the board after i steps,
+    rebuilt from the closest keyframe at or before it, so any board costs at most keyframeInterval moves
+    """
+
+    def __init__(self, path) -> None:
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, flags, self.keyframeInterval, numSteps, numKeyframes,
+         self.score, self.linesCleared, seed,
+         agentId) = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a version {VERSION} replay")
+        self.trackColors = bool(flags & FLAG_COLORS)
+        self.seed = seed if flags & FLAG_SEED else None
+        self.agentId = agentId.rstrip(b"\0").decode()
+        # The encoded steps, steps() is the method that turns them into GameSteps
+        self.codes = np.frombuffer(self.mmap,
+                                   dtype="<u2",
+                                   count=numSteps,
+                                   offset=HEADER_SIZE)
+        offset = HEADER_SIZE + 2 * numSteps
+        self.keyframeRows = np.frombuffer(self.mmap,
+                                          dtype="<u2",
+                                          count=numKeyframes * BOARD_HEIGHT,
+                                          offset=offset).reshape(
+                                              numKeyframes, BOARD_HEIGHT)
+        self.keyframeColors = None
+        if self.trackColors:
+            self.keyframeColors = np.frombuffer(
+                self.mmap,
+                dtype=np.uint8,
+                count=numKeyframes * BOARD_HEIGHT * BOARD_WIDTH,
+                offset=offset + 2 * numKeyframes * BOARD_HEIGHT).reshape(
+                    numKeyframes, BOARD_HEIGHT, BOARD_WIDTH)
+        # The last board that was rebuilt, reading boards in order only ever plays one move per board
+        self.cursor = (0, Board(trackColors=self.trackColors))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return decodeStep(int(self.codes[i]))
+
+    def keyframe(self, k) -> Board:
+        """
+        The board after (k + 1) * keyframeInterval steps
+        """
+        colors = None
+        if self.trackColors:
+            colors = tuple({int(x): int(row[x])
+                            for x in np.flatnonzero(row)}
+                           for row in self.keyframeColors[k])
+        return Board.from_rows([int(r) for r in self.keyframeRows[k]], colors)
+
+    def board(self, i) -> Board:
+        if i < 0 or i > len(self):
+            raise IndexError(f"Replay has boards 0 to {len(self)}")
+        k = i // self.keyframeInterval
+        start = k * self.keyframeInterval
+        cursorIndex, board = self.cursor
+        if not start <= cursorIndex <= i:
+            if k == 0:
+                board = Board(trackColors=self.trackColors)
+            else:
+                board = self.keyframe(k - 1)
+            cursorIndex = start
+        for j in range(cursorIndex, i):
+            board, _ = board.make_move(*self[j])
+        self.cursor = (i, board)
+        return board
+
+    def boards(self, start=0):
+        """
+        Yields the board after every step from step start on
+        """
+        for i in range(start + 1, len(self) + 1):
+            yield self.board(i)
+
+    def steps(self, start=0):
+        """
+        Yields a GameStep for every step from step start on, like TetrisSimulation.steps
+        """
+        board = self.board(start)
+        for i in range(start, len(self)):
+            piece, move = self[i]
+            board, rowsCleared = board.make_move(piece, move)
+            self.cursor = (i + 1, board)
+            yield GameStep(board, piece, move, rowsCleared)
+
+    def moves(self, start=0):
+        for i in range(start, len(self)):
+            yield self[i][1]
+
+    def pieces(self, start=0):
+        for i in range(start, len(self)):
+            yield self[i][0]
+
+    def close(self) -> None:
+        # The arrays point into the map, they have to go before it can close
+        self.codes = self.keyframeRows = self.keyframeColors = None
+        self.cursor = None
+        self.mmap.close()
@@ -0,0 +1,286 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+from contextlib import contextmanager
+
+from constants import BOARD_HEIGHT
+from gameRecord import encodeStep, decodeStep
+
+# A store is three files next to each other:
+# path.log is an append-only log of records, each the key, the number of placements and one uint16 per placement (GameRecord encoding)
+# path.idx is an open addressing hash table of (key hash, log offset) slots that is memory mapped, offset 0 marks an empty slot
+# path.lock is only there to be locked, writers hold it exclusively and readers hold it shared while they open the files
+# Everything is little endian
+LOG_MAGIC = b"TPLG"
+INDEX_MAGIC = b"TPIX"
+VERSION = 1
+LOG_HEADER = struct.Struct("<4sH")
+LOG_HEADER_SIZE = 16
+# magic, version, stale, capacity, entries, bytes of the log no slot points to anymore
+INDEX_HEADER = struct.Struct("<4sHHQQQ")
+INDEX_HEADER_SIZE = 64
+STALE_OFFSET = 6
+# The board rows and the piece number
+KEY = struct.Struct("<{}HB".format(BOARD_HEIGHT))
+RECORD_HEAD = struct.Struct("<{}sH".format(KEY.size))
+# The index grows once it is more than this full
+MAX_LOAD = 0.5
+
+
+def placementKey(board, piece) -> bytes:
+    return KEY.pack(*board.get_rows(), piece.number)
+
+
+def keyHash(key: bytes) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class PlacementStore:
+    """
+    Persistent cache of the placements of a piece on a board, that never has to be loaded into memory
+    Lookups hash the key into the memory mapped index and read one record from the log, so opening a store of any size is instant
+    Any number of processes can read while others write, writers take turns through the lock file
+    Records are only ever appended, a put for a key that is already there leaves the old record behind until compact is run
+    The index and log are replaced with os.replace when the index grows or the store is compacted,
+    and the old index is marked stale so readers that still have it open know to open the new files
+    """
+
+    def __init__(self, path, readOnly=False, initialCapacity=1 << 16) -> None:
+        if initialCapacity & (initialCapacity - 1):
+            raise ValueError("Index capacity must be a power of two")
+        self.logPath = path + ".log"
+        self.indexPath = path + ".idx"
+        self.readOnly = readOnly
+        self.hits = 0
+        self.misses = 0
+        self.index = None
+        self.lockFile = open(path + ".lock", "rb" if readOnly else "ab")
+        with self.locked(fcntl.LOCK_SH if readOnly else fcntl.LOCK_EX):
+            if not readOnly and not os.path.exists(self.indexPath):
+                self.create(initialCapacity)
+            self.open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.header()[4]
+
+    @contextmanager
+    def locked(self, operation):
+        fcntl.flock(self.lockFile, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+
+    def create(self, capacity) -> None:
+        with open(self.logPath, "wb") as f:
+            f.write(
+                LOG_HEADER.pack(LOG_MAGIC,
+                                VERSION).ljust(LOG_HEADER_SIZE, b"\0"))
+        self.writeIndex(self.indexPath, capacity, [], 0)
+
+    def writeIndex(self, path, capacity, slots, garbage) -> None:
+        """
+        Writes a new index file holding the given (hash, offset) slots
+        """
+        table = array("Q", bytes(16 * capacity))
+        mask = capacity - 1
+        for h, offset in slots:
+            i = h & mask
+            while table[2 * i + 1]:
+                i = (i + 1) & mask
+            table[2 * i] = h
+            table[2 * i + 1] = offset
+        header = INDEX_HEADER.pack(INDEX_MAGIC, VERSION, 0, capacity,
+                                   len(slots), garbage)
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            f.write(header.ljust(INDEX_HEADER_SIZE, b"\0"))
+            f.write(table.tobytes())
+        os.replace(tmpPath, path)
+
+    def open(self) -> None:
+        self.logFd = os.open(self.logPath, os.O_RDONLY)
+        self.logFile = None if self.readOnly else open(self.logPath, "ab")
+        with open(self.indexPath, "rb" if self.readOnly else "r+b") as f:
+            self.index = mmap.mmap(f.fileno(),
+                                   0,
+                                   access=mmap.ACCESS_READ
+                                   if self.readOnly else mmap.ACCESS_WRITE)
+        magic, version, _, self.capacity, _, _ = self.header()
+        if magic != INDEX_MAGIC or version != VERSION:
+            raise ValueError(f"{self.indexPath} is not a placement index")
+        # The slots are read and written in place as native uint64s, which is little endian everywhere this runs
+        self.slots = memoryview(self.index)[INDEX_HEADER_SIZE:].cast("Q")
+
+    def release(self) -> None:
+        self.slots.release()
+        self.index.close()
+        os.close(self.logFd)
+        if self.logFile is not None:
+            self.logFile.close()
+        self.index = None
+
+    def reopen(self) -> None:
+        self.release()
+        with self.locked(fcntl.LOCK_SH):
+            self.open()
+
+    def header(self) -> tuple:
+        return INDEX_HEADER.unpack_from(self.index)
+
+    def stale(self) -> bool:
+        return self.header()[2] != 0
+
+    def find(self, key: bytes, h: int):
+        """
+        Returns the slot of the key and the offset of its record, or the empty slot it would go in and 0
+        """
+        mask = self.capacity - 1
+        i = h & mask
+        while True:
+            offset = self.slots[2 * i + 1]
+            if offset == 0:
+                return i, 0
+            if self.slots[2 * i] == h and os.pread(self.logFd, KEY.size,
+                                                   offset) == key:
+                return i, offset
+            i = (i + 1) & mask
+
+    def readRecord(self, offset) -> array:
+        _, count = RECORD_HEAD.unpack(
+            os.pread(self.logFd, RECORD_HEAD.size, offset))
+        codes = array("H")
+        codes.frombytes(
+            os.pread(self.logFd, 2 * count, offset + RECORD_HEAD.size))
+        return codes
+
+    def get(self, board, piece) -> list:
+        """
+        Returns the saved moves of the piece on the board, or None if there are none
+        """
+        key = placementKey(board, piece)
+        h = keyHash(key)
+        _, offset = self.find(key, h)
+        if offset == 0 and self.stale():
+            self.reopen()
+            _, offset = self.find(key, h)
+        if offset == 0:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [decodeStep(code)[1] for code in self.readRecord(offset)]
+
+    def put(self, board, piece, moves) -> None:
+        if self.readOnly:
+            raise RuntimeError("Placement store was opened read only")
+        key = placementKey(board, piece)
+        h = keyHash(key)
+        codes = array("H", (encodeStep(piece, move) for move in moves))
+        with self.locked(fcntl.LOCK_EX):
+            if self.stale():
+                self.release()
+                self.open()
+            _, _, _, capacity, entries, garbage = self.header()
+            if entries + 1 > capacity * MAX_LOAD:
+                self.rebuild(capacity * 2, compact=False)
+                garbage = self.header()[5]
+            slot, oldOffset = self.find(key, h)
+            self.logFile.seek(0, os.SEEK_END)
+            offset = self.logFile.tell()
+            self.logFile.write(RECORD_HEAD.pack(key, len(codes)))
+            self.logFile.write(codes.tobytes())
+            # The record has to be readable before any reader can find its slot
+            self.logFile.flush()
+            if oldOffset:
+                garbage += RECORD_HEAD.size + 2 * len(
+                    self.readRecord(oldOffset))
+            else:
+                entries += 1
+            self.slots[2 * slot] = h
+            self.slots[2 * slot + 1] = offset
+            struct.pack_into("<QQ", self.index, 16, entries, garbage)
+
+    def rebuild(self, capacity, compact) -> None:
+        """
+        Replaces the index with one of the given capacity, compact also rewrites the log with only the records the index points to
+        Must be called while holding the lock exclusively
+        """
+        slots = [(self.slots[2 * i], self.slots[2 * i + 1])
+                 for i in range(self.capacity) if self.slots[2 * i + 1]]
+        garbage = self.header()[5]
+        if compact:
+            tmpPath = self.logPath + ".tmp"
+            moved = []
+            with open(tmpPath, "wb") as f:
+                f.write(
+                    LOG_HEADER.pack(LOG_MAGIC,
+                                    VERSION).ljust(LOG_HEADER_SIZE, b"\0"))
+                # Records are copied in log order so reads stay close together
+                for h, offset in sorted(slots, key=lambda s: s[1]):
+                    count = RECORD_HEAD.unpack(
+                        os.pread(self.logFd, RECORD_HEAD.size, offset))[1]
+                    moved.append((h, f.tell()))
+                    f.write(
+                        os.pread(self.logFd, RECORD_HEAD.size + 2 * count,
+                                 offset))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, self.logPath)
+            slots = moved
+            garbage = 0
+        self.writeIndex(self.indexPath, capacity, slots, garbage)
+        # Everyone still holding the old index opens the new files on their next miss
+        struct.pack_into("<H", self.index, STALE_OFFSET, 1)
+        self.release()
+        self.open()
+
+    def compact(self) -> None:
+        """
+        Rewrites the log without the records that were replaced by later puts
+        """
+        with self.locked(fcntl.LOCK_EX):
+            if self.stale():
+                self.release()
+                self.open()
+            # The index also shrinks if it is much bigger than the entries need
+            capacity = 1 << 4
+            while len(self) > capacity * MAX_LOAD / 2:
+                capacity *= 2
+            self.rebuild(min(capacity, self.capacity), compact=True)
+
+    def sync(self) -> None:
+        """
+        Makes everything written so far durable
+        """
+        if self.logFile is not None:
+            self.logFile.flush()
+            os.fsync(self.logFile.fileno())
+            self.index.flush()
+
+    def stats(self) -> dict:
+        _, _, _, capacity, entries, garbage = self.header()
+        lookups = self.hits + self.misses
+        return dict(entries=entries,
+                    capacity=capacity,
+                    loadFactor=entries / capacity,
+                    logBytes=os.fstat(self.logFd).st_size,
+                    garbageBytes=garbage,
+                    hits=self.hits,
+                    misses=self.misses,
+                    hitRate=self.hits / lookups if lookups else 0.0)
+
+    def close(self) -> None:
+        if self.index is not None:
+            self.sync()
+            self.release()
+        self.lockFile.close()
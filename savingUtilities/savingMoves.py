@@ -1,42 +1,37 @@
-import pickle
+from savingUtilities.placementStore import PlacementStore
 
-SAVED_BOARDS_NAME = "savedBoards.dat"
+SAVED_PLACEMENTS_NAME = "savedPlacements"
 
 
 class SavingMoves:
 
-    def __init__(self):
-        try:
-            with open(SAVED_BOARDS_NAME, "rb") as savedBoardsFile:
-                self.d = pickle.load(savedBoardsFile)
-        except FileNotFoundError:
-            self.d = {}
-        self.currentNumberSaved = len(self.d)
-        self.timesQueried = 0
-        self.timesCachedUsed = 0
+    def __init__(self, path=SAVED_PLACEMENTS_NAME, readOnly=False):
+        # Nothing is loaded here, the store looks every board up on disk
+        self.store = PlacementStore(path, readOnly=readOnly)
+        self.currentNumberSaved = len(self.store)
 
-        print("Successfully Opened Saved Boards File With {} Entries".format(
-            len(self.d)))
+        print("Successfully Opened Saved Placements With {} Entries".format(
+            len(self.store)))
 
     def loadMoves(self, board, piece):
-        self.timesQueried += 1
-        if (board, piece) in self.d:
-            self.timesCachedUsed += 1
-            return self.d[(board, piece)]
+        # Only the moves are stored, the boards they lead to are cheap to make again
+        moves = self.store.get(board, piece)
+        if moves is not None:
+            return [board.make_move(piece, m)[0] for m in moves]
 
-    def saveBoards(self, board, piece, boards):
-        self.d[(board, piece)] = boards
+    def saveMoves(self, board, piece, moves):
+        self.store.put(board, piece, moves)
 
     def recordAllMoves(self):
-        with open(SAVED_BOARDS_NAME, "wb") as savedBoardsFile:
-            pickle.dump(self.d, savedBoardsFile)
+        # Every move set is already in the store's log, this just makes sure it is on disk
+        self.store.sync()
         # print number of saved moves
         print("Successfully Saved {} move sets".format(
-            len(self.d) - self.currentNumberSaved))
-        self.currentNumberSaved = len(self.d)
+            len(self.store) - self.currentNumberSaved))
+        self.currentNumberSaved = len(self.store)
 
     def printStats(self):
-        print("Times Queried: {}".format(self.timesQueried))
-        print("Times Cached Used: {}".format(self.timesCachedUsed))
-        print("Times Cached Missed: {}".format(self.timesQueried -
-                                               self.timesCachedUsed))
+        stats = self.store.stats()
+        print("Times Queried: {}".format(stats["hits"] + stats["misses"]))
+        print("Times Cached Used: {}".format(stats["hits"]))
+        print("Times Cached Missed: {}".format(stats["misses"]))
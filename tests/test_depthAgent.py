@@ -0,0 +1,22 @@
+from constants import BOARD_HEIGHT, BOARD_WIDTH
+from hueristics import sumHueristic
+from piece import smashboy
+from tetrisAgent import DepthAgent
+from tetrisClasses import Board
+
+
+def boardWithBottomRow(color) -> Board:
+    matrix = [[0] * BOARD_WIDTH for _ in range(BOARD_HEIGHT)]
+    matrix[-1][:4] = [color] * 4
+    return Board(matrix)
+
+
+def test_table_keeps_boards_with_other_colors_apart():
+    agent = DepthAgent(sumHueristic)
+    blue, yellow = boardWithBottomRow(1), boardWithBottomRow(4)
+    agent.get_children(blue, smashboy)
+    children = agent.get_children(yellow, smashboy)
+    assert all(
+        child.get_square(0, BOARD_HEIGHT - 1) == 4 for _, child in children)
+    assert agent.evaluate(blue) == 4
+    assert agent.evaluate(yellow) == 16
@@ -0,0 +1,71 @@
+import numpy as np
+
+from constants import BOARD_HEIGHT, BOARD_WIDTH
+from hueristics import featureVector, featureMatrix, packBoards, packSquares
+from tetrisAgent import FeatureAgent
+from tetrisClasses import Board
+from tetrisPieceGenerator import TetrisPieceGenerator
+from tetrisSimulation import TetrisSimulation
+from tetrisUtilities import get_all_drop_moves, get_all_legal_moves, packAfterstates
+
+
+def boardWithSquares(squares) -> list:
+    matrix = [[0] * BOARD_WIDTH for _ in range(BOARD_HEIGHT)]
+    for (x, y), color in squares.items():
+        matrix[y][x] = color
+    return matrix
+
+
+def test_transitions_count_color_changes():
+    # Two stacked squares and two side by side squares of different colors, in the top BOARD_WIDTH rows
+    matrix = boardWithSquares({(0, 1): 1, (0, 2): 2, (3, 5): 4, (4, 5): 6})
+    colored = Board(matrix)
+    plain = Board(matrix, trackColors=False)
+    assert colored.get_num_row_transitions(
+    ) == plain.get_num_row_transitions() + 1
+    assert colored.get_num_column_transitions(
+    ) == plain.get_num_column_transitions() + 1
+
+
+def test_feature_matrix_matches_feature_vector():
+    gen = TetrisPieceGenerator(5)
+    for trackColors in (True, False):
+        board = Board(trackColors=trackColors)
+        for _ in range(40):
+            piece = next(gen)
+            children = [
+                board.make_move(piece, m)[0]
+                for m in get_all_legal_moves(board, piece)
+            ]
+            expected = np.array([featureVector(c, board) for c in children])
+            assert np.array_equal(featureMatrix(children, board), expected)
+            if not trackColors:
+                rows = np.array([c.get_rows() for c in children],
+                                dtype=np.uint16)
+                assert np.array_equal(featureMatrix(rows, board), expected)
+            board = min(children, key=Board.get_aggregate_height)
+
+
+def test_pack_afterstates_matches_make_move():
+    weights = [0, -0.51, -0.36, -0.18, -0.3, -0.3, -0.1, 0.76, -100]
+    for trackColors in (True, False):
+        sim = TetrisSimulation(FeatureAgent(featureVector, weights),
+                               numKnownPieces=1,
+                               trackColors=trackColors,
+                               seed=2)
+        board = sim.board
+        linesCleared = 0
+        for step in sim.steps(150):
+            moves = sorted(get_all_drop_moves(board, step.piece),
+                           key=lambda m: (m.rotation, m.x, m.y))
+            children = [board.make_move(step.piece, m)[0] for m in moves]
+            packed = packAfterstates(board, step.piece, moves)
+            if trackColors:
+                expected = packSquares(children)
+            else:
+                expected = packBoards(children)
+            assert np.array_equal(packed, expected)
+            board = step.board
+            linesCleared += step.rowsCleared
+        # The game has to clear rows for the clearing to be checked
+        assert linesCleared > 0
@@ -0,0 +1,75 @@
+import pytest
+
+from hueristics import featureVector
+from replay import Replay, saveReplay
+from tetrisAgent import FeatureAgent
+from tetrisSimulation import TetrisSimulation
+
+WEIGHTS = [0, -0.51, -0.36, -0.18, -0.3, -0.3, -0.1, 0.76, -100]
+
+
+def playLiveGame(seed, numMoves):
+    sim = TetrisSimulation(FeatureAgent(featureVector, WEIGHTS),
+                           numKnownPieces=1,
+                           seed=seed)
+    steps = list(sim.steps(numMoves))
+    sim = TetrisSimulation(FeatureAgent(featureVector, WEIGHTS),
+                           numKnownPieces=1,
+                           seed=seed)
+    board, score, survived, boards, record, pieces, linesCleared = sim.playGame(
+        max_moves=numMoves, record="compact")
+    return steps, record, score, linesCleared
+
+
+@pytest.fixture
+def replayFile(tmp_path):
+    steps, record, score, linesCleared = playLiveGame(3, 300)
+    path = str(tmp_path / "game.replay")
+    # A small interval so the game crosses several keyframes
+    saveReplay(path,
+               record,
+               seed=3,
+               score=score,
+               linesCleared=linesCleared,
+               keyframeInterval=64)
+    return path, steps
+
+
+def assertSameSteps(replayed, live):
+    assert len(replayed) == len(live)
+    for got, expected in zip(replayed, live):
+        assert got.piece == expected.piece
+        assert got.move == expected.move
+        assert got.rowsCleared == expected.rowsCleared
+        assert got.board == expected.board
+
+
+def test_steps_match_live_game(replayFile):
+    path, live = replayFile
+    with Replay(path) as replay:
+        assert len(replay) == len(live)
+        assertSameSteps(list(replay.steps()), live)
+
+
+def test_steps_from_the_middle(replayFile):
+    path, live = replayFile
+    with Replay(path) as replay:
+        # Jump past a keyframe first so steps has to start from a rebuilt board
+        replay.board(200)
+        assertSameSteps(list(replay.steps(100)), live[100:])
+
+
+def test_play_replay_streams_steps(replayFile, monkeypatch):
+    pytest.importorskip("pygame")
+    pygameAnimation = pytest.importorskip("pygameAnimation")
+    path, live = replayFile
+    played = {}
+
+    def record(steps, delay=.005, startBoard=None):
+        played["startBoard"] = startBoard
+        played["steps"] = list(steps)
+
+    monkeypatch.setattr(pygameAnimation, "playAnimation", record)
+    pygameAnimation.playReplay(path, start=10)
+    assert played["startBoard"] == live[9].board
+    assertSameSteps(played["steps"], live[10:])
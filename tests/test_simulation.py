@@ -0,0 +1,75 @@
+import numpy as np
+
+from hueristics import featureVector, packBoards, packSquares
+from piece import PIECES
+from tetrisAgent import FeatureAgent
+from tetrisClasses import Board
+from tetrisSimulation import TetrisSimulation, VectorTetrisSimulation, LinearPopulationSimulation
+from tetrisUtilities import DROP_CLEARANCE, DROP_TABLES, drop_afterstates, get_all_drop_moves, move_order, packAfterstates
+
+WEIGHTS = [0, -0.51, -0.36, -0.18, -0.3, -0.3, -0.1, 0.76, -100]
+SEEDS = [11, 12, 13, 14]
+
+
+def playedScores(numMoves) -> list:
+    return [
+        TetrisSimulation(FeatureAgent(featureVector, WEIGHTS),
+                         numKnownPieces=1,
+                         seed=seed).playGame(max_moves=numMoves)[1]
+        for seed in SEEDS
+    ]
+
+
+def test_training_plays_the_same_games_as_play():
+    # Training and play both keep colors, so the same weights on the same pieces score the same
+    expected = playedScores(150)
+    sim = VectorTetrisSimulation(FeatureAgent(featureVector, WEIGHTS),
+                                 numGames=len(SEEDS),
+                                 numKnownPieces=1,
+                                 seeds=SEEDS)
+    assert [game[1] for game in sim.playGames(max_moves=150)] == expected
+    population = LinearPopulationSimulation(featureVector, [WEIGHTS],
+                                            numGames=len(SEEDS),
+                                            seeds=SEEDS)
+    assert population.evaluate(max_moves=150)[0] == np.mean(expected)
+
+
+def test_drop_afterstates_match_single_board_drops():
+    sim = TetrisSimulation(FeatureAgent(featureVector, WEIGHTS),
+                           numKnownPieces=1,
+                           seed=1)
+    boards = [
+        step.board for step in sim.steps(200)
+        if step.board.get_highest_block() >= DROP_CLEARANCE
+    ]
+    rows = packBoards(boards)
+    heights = np.array([b.get_column_heights() for b in boards])
+    squares = packSquares(boards)
+    for piece in PIECES:
+        table = DROP_TABLES[piece.number]
+        ys, colored = drop_afterstates(rows, heights, piece, squares)
+        _, plain = drop_afterstates(rows, heights, piece)
+        for j, board in enumerate(boards):
+            moves = sorted(get_all_drop_moves(board, piece), key=move_order)
+            assert [table.move(k, ys[j, k])
+                    for k in range(len(table))] == moves
+            assert np.array_equal(colored[j],
+                                  packAfterstates(board, piece, moves))
+            assert np.array_equal(
+                plain[j],
+                packAfterstates(Board.from_rows(board.get_rows()), piece,
+                                moves))
+
+
+def test_tucking_agents_play_the_same_games_batched():
+    agent = FeatureAgent(featureVector, WEIGHTS, allowTucks=True)
+    expected = [
+        TetrisSimulation(agent, numKnownPieces=1,
+                         seed=seed).playGame(max_moves=100)[1]
+        for seed in SEEDS
+    ]
+    sim = VectorTetrisSimulation(agent,
+                                 numGames=len(SEEDS),
+                                 numKnownPieces=1,
+                                 seeds=SEEDS)
+    assert [game[1] for game in sim.playGames(max_moves=100)] == expected
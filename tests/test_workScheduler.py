@@ -0,0 +1,81 @@
+import functools
+import os
+import time
+
+import pytest
+
+from workScheduler import WorkScheduler
+
+
+def square(x) -> int:
+    return x * x
+
+
+def failOnSeven(x) -> int:
+    if x == 7:
+        raise ValueError("seven")
+    return x
+
+
+def dieOnceOnSeven(marker, x) -> int:
+    # The first worker to reach 7 dies without reporting back, the restarted copy of the chunk succeeds
+    if x == 7 and not os.path.exists(marker):
+        open(marker, "w").close()
+        os._exit(1)
+    return x * x
+
+
+def sleepAfterTwo(x) -> int:
+    if x >= 2:
+        time.sleep(0.02)
+    return x
+
+
+def test_results_keep_their_index_across_batches():
+    with WorkScheduler(square, numWorkers=3, speculate=False) as scheduler:
+        for items in (range(50), range(100, 113)):
+            results = list(scheduler.map(items))
+            assert sorted(results) == [(i, x * x)
+                                       for i, x in enumerate(items)]
+        assert scheduler.stats()["items"] == 13
+
+
+def test_worker_errors_are_raised_with_the_traceback():
+    with WorkScheduler(failOnSeven, numWorkers=2) as scheduler:
+        with pytest.raises(RuntimeError, match="ValueError: seven"):
+            list(scheduler.map(range(20)))
+
+
+def test_chunks_of_dead_workers_are_run_again(tmp_path):
+    evaluator = functools.partial(dieOnceOnSeven, str(tmp_path / "died"))
+    with WorkScheduler(evaluator, numWorkers=2, speculate=False) as scheduler:
+        assert sorted(scheduler.map(range(20))) == [(i, i * i)
+                                                    for i in range(20)]
+        assert scheduler.stats()["restarted"] == 1
+        assert all(w.is_alive() for w in scheduler.workers)
+
+
+def test_late_starts_of_finished_chunks_are_ignored():
+    items = list(range(24))
+    with WorkScheduler(sleepAfterTwo, numWorkers=3) as scheduler:
+        chunkOf = {
+            i: chunkId
+            for chunkId, chunk in enumerate(scheduler.guided_chunks(items))
+            for i, _ in chunk
+        }
+        runningSeen = []
+        redispatch = scheduler.redispatch
+
+        def spy(batchId, chunks, chunkSizes, running, *args):
+            runningSeen.append(set(running))
+            return redispatch(batchId, chunks, chunkSizes, running, *args)
+
+        scheduler.redispatch = spy
+        results = scheduler.map(items)
+        first = next(results)
+        finished = chunkOf[first[0]]
+        # A copy of the chunk that only starts after the chunk has finished
+        scheduler.results.put(("start", 0, scheduler.batchId, finished, None))
+        assert sorted([first] + list(results)) == [(i, i) for i in items]
+        assert runningSeen
+        assert not any(finished in running for running in runningSeen)
@@ -1,14 +1,11 @@
 import random
 import numpy as np
-import tensorflow as tf
-
-from tensorflow import keras
-from tensorflow.python.keras.layers import Dense
 
 from tetrisClasses import Board, Piece, Move, TetrisPlacementState
-from tetrisUtilities import get_all_drop_moves, get_all_drop_boards, is_state_legal, is_state_goal, generate_boards_from_pieces
+from tetrisUtilities import get_all_legal_moves, get_all_drop_moves, get_all_drop_boards, is_state_legal, is_state_goal, generate_boards_from_pieces, best_placement
 from myLogger import getModuleLogger
-from hueristics import featureVector
+from transpositionTable import TranspositionTable
+from hueristics import featureVector, getFeatureMatrixGenerator
 
 
 class TetrisAgent():
@@ -20,9 +17,36 @@ class TetrisAgent():
         raise NotImplementedError()
 
 
+_keras = None
+
+
+def loadKeras() -> tuple:
+    """
+    Imports tensorflow the first time a keras network is built, so nothing else in the engine has to pay for loading it
+    Returns (keras, Dense)
+    """
+    global _keras
+    if _keras is None:
+        import tensorflow as tf
+        from tensorflow import keras
+        from tensorflow.python.keras.layers import Dense
+        # Using a GPU is kinda unnecesssary here and threading is faster since we dont actually train any models
+        # This has to happen before tensorflow sets up its devices, so it can only be done once
+        tf.config.set_visible_devices([], 'GPU')
+        _keras = (keras, Dense)
+    return _keras
+
+
 class SimpleAgent(TetrisAgent):
 
+    def __init__(self, allowTucks=False) -> None:
+        super().__init__()
+        # By default pieces are only dropped, allowTucks also lets agents slide and spin pieces under overhangs
+        self.allowTucks = allowTucks
+
     def get_all_moves(self, board: Board, piece: Piece) -> list:
+        if self.allowTucks:
+            return get_all_legal_moves(board, piece)
         return get_all_drop_moves(board, piece)
 
     def get_move(self, board, pieces):
@@ -39,66 +63,154 @@ class RandomAgent(SimpleAgent):
 
 class DepthAgent(SimpleAgent):
 
-    def __init__(self, hueristic, depth=1) -> None:
-        super().__init__()
+    def __init__(self,
+                 hueristic,
+                 depth=1,
+                 allowTucks=False,
+                 tableSize=20000) -> None:
+        super().__init__(allowTucks)
         self.hueristic = hueristic  # here the hueristic is simply a function that takes in a board
         self.depth = depth
+        # Different first moves often lead to the same boards, and the next move searches most of the same tree again
+        # So the children of every (board, piece) and the value of every board are kept between moves
+        # tableSize is the number of boards the table can hold before it starts evicting
+        # Hits almost all come from the previous move's search, a depth 2 search only keeps about 2000 boards per move
+        self.table = TranspositionTable(tableSize)
+
+    def get_children(self, board: Board, piece: Piece) -> tuple:
+        """
+        Returns the (move, new board) pairs for every move of the piece
+        """
+        # Boards are keys themselves, so boards with colors only match boards with the same colors and every child keeps its own colors
+        key = (board, piece.number)
+        children = self.table.get(key)
+        if children is None:
+            children = tuple((m, board.make_move(piece, m)[0])
+                             for m in self.get_all_moves(board, piece))
+            self.table.put(key, children, len(children) + 1)
+        return children
+
+    def evaluate(self, board: Board):
+        # The hueristic can read colors too, None keeps the key apart from the children keys
+        key = (board, None)
+        value = self.table.get(key)
+        if value is None:
+            value = self.hueristic(board)
+            self.table.put(key, value)
+        return value
 
     def get_move(self, board, pieces):
         if len(pieces) < self.depth:
             raise ValueError(
                 "Cannot perform depth search, not enough pieces provided")
-        moves = self.get_all_moves(board, pieces[0])
+        # The first level was usually expanded by the previous move already
         prevBoards = {}
-        for m in moves:
-            prevBoards[board.make_move(pieces[0], m)[0]] = m
+        for m, b in self.get_children(board, pieces[0]):
+            prevBoards[b] = m
 
         # Ok so here we are keeping track of the original move and the board that resulted from that move
         # We don't care about future moves, just the boards the represent
         # With the default depth value this is not run
-        # If depth = 2 each move takes about .2 seconds, this is not fast enough
+        # Without the transposition table depth = 2 takes about .2 seconds a move, this is not fast enough
         for i in range(self.depth -
                        1):  # reducing depth since manually did first iteration
             newBoards = {}
             for b, move in prevBoards.items():
-                possibleBoards = get_all_drop_boards(b, pieces[i + 1])
-                for pb in possibleBoards:
+                for _, pb in self.get_children(b, pieces[i + 1]):
                     newBoards[pb] = move
             prevBoards = newBoards
         boards = prevBoards
         self.logger.debug(f"Evaluating {len(boards)} boards")
         self.logger.debug(pieces[:self.depth])
-        evaluations = [(self.hueristic(b), move) for b, move in boards.items()]
+        evaluations = [(self.evaluate(b), move) for b, move in boards.items()]
+        self.logger.debug(f"Transposition table: {self.table.stats()}")
         if len(evaluations) == 0:
             return None
         return max(evaluations, key=lambda x: x[0])[1]
 
 
+class BeamAgent(SimpleAgent):
+    """
+    Looks ahead through the known pieces like DepthAgent, but only keeps the beamWidth best boards of every level
+    Boards are ranked by a cheap hueristic (customHueristic for example), and the boards that are left after the last piece are scored by the evaluator
+    This makes the cost of a move grow linearly with the depth instead of exponentially
+    """
+
+    def __init__(self,
+                 cheapHueristic,
+                 evaluator=None,
+                 beamWidth=10,
+                 depth=None,
+                 allowTucks=False) -> None:
+        super().__init__(allowTucks)
+        self.cheapHueristic = cheapHueristic
+        # Both hueristics are functions that take in a board
+        self.evaluator = evaluator if evaluator is not None else cheapHueristic
+        self.beamWidth = beamWidth
+        self.depth = depth  # None looks ahead through every known piece
+
+    def prune(self, beam: list) -> list:
+        # beam is a list of (board, root move), keeps the beamWidth best by the cheap hueristic
+        if len(beam) <= self.beamWidth:
+            return beam
+        return sorted(beam,
+                      key=lambda x: self.cheapHueristic(x[0]),
+                      reverse=True)[:self.beamWidth]
+
+    def get_move(self, board, pieces):
+        if self.depth is not None:
+            if len(pieces) < self.depth:
+                raise ValueError(
+                    "Cannot perform beam search, not enough pieces provided")
+            pieces = pieces[:self.depth]
+        beam = {}
+        for m in self.get_all_moves(board, pieces[0]):
+            beam[board.make_move(pieces[0], m)[0]] = m
+        beam = list(beam.items())
+        if len(beam) == 0:
+            return None
+        for piece in pieces[1:]:
+            beam = self.prune(beam)
+            nextBeam = {}
+            for b, rootMove in beam:
+                for m in self.get_all_moves(b, piece):
+                    nextBeam[b.make_move(piece, m)[0]] = rootMove
+            if len(nextBeam) == 0:
+                break  # Every board left loses here, so we judge the ones we have
+            beam = list(nextBeam.items())
+        beam = self.prune(beam)
+        self.logger.debug(f"Evaluating {len(beam)} boards")
+        return max(beam, key=lambda x: self.evaluator(x[0]))[1]
+
+
 class FeatureAgent(SimpleAgent):
     """
     So lets be clear, this agent is AWESOME if weighted correctly. 
     Training this agent to infinitely clear lines is very doable
     """
 
-    def __init__(self, featureVectorGenerator, weights):
-        super().__init__()
+    def __init__(self, featureVectorGenerator, weights, allowTucks=False):
+        super().__init__(allowTucks)
         self.featureVectorGenerator = featureVectorGenerator
+        self.featureMatrixGenerator = getFeatureMatrixGenerator(
+            featureVectorGenerator)
+        self.weights = weights
+
+    def set_weights(self, weights) -> None:
         self.weights = weights
 
+    def score_features(self, features):
+        # Summed row by row so a row scores the same whatever else is in the batch, LinearPopulationSimulation scores the same way
+        return (features * np.asarray(self.weights, dtype=float)).sum(axis=1)
+
     def get_move(self, board, pieces):
-        moves = self.get_all_moves(board, pieces[0])
-        prevBoards = {}
-        for m in moves:
-            prevBoards[board.make_move(pieces[0], m)[0]] = m
-        evaluations = [(np.dot(self.featureVectorGenerator(b, board),
-                               self.weights), move)
-                       for b, move in prevBoards.items()]
-        if len(evaluations) == 0:
+        # All of the afterstates are featurized at once into an (N, F) matrix, only the chosen one becomes a Board
+        best = best_placement(board, pieces[0], self.score_features,
+                              self.featureMatrixGenerator,
+                              self.get_all_moves(board, pieces[0]))
+        if best is None:
             return None
-        del prevBoards
-        maxEval = max(evaluations, key=lambda x: x[0])[1]
-        del evaluations
-        return maxEval
+        return best[0]
 
 
 class NetworkAgent(SimpleAgent):
@@ -112,57 +224,114 @@ class NetworkAgent(SimpleAgent):
     be allowed to have a more complex set of behaviors. 
     """
 
-    def __init__(self, featureVectorGenerator, weights) -> None:
-        super().__init__()
+    def __init__(self,
+                 featureVectorGenerator,
+                 weights,
+                 allowTucks=False,
+                 backend="keras") -> None:
+        super().__init__(allowTucks)
         self.featureVectorGenerator = featureVectorGenerator
+        self.featureMatrixGenerator = getFeatureMatrixGenerator(
+            featureVectorGenerator)
         self.numFeatures = len(featureVectorGenerator(Board(), Board()))
-        self.network = keras.Sequential([
-            Dense(self.numFeatures, name="layer1", use_bias=True),
-            Dense(self.numFeatures,
-                  activation="selu",
-                  name="layer2",
-                  use_bias=False),
-            Dense(1, name="layer3", use_bias=False)
-        ])
-
-        init_feature_vector = featureVectorGenerator(Board(), Board())
-        fv = np.asmatrix(init_feature_vector)
-        self.network(fv)
-        # print(self.network.layers[0].get_weights()[1])
-        composite_list = [
-            np.array(weights[x:x + self.numFeatures])
-            for x in range(0, len(weights), self.numFeatures)
-        ]
-        layer1Weights = np.array(composite_list[:self.numFeatures],
-                                 dtype=object)
-        layer1Bias = np.array(
-            composite_list[self.numFeatures:self.numFeatures + 1],
-            dtype=object)[0]
-        # print("Layer1 Weights: ", layer1Weights)
-        # print("Layer1 Bias: ", layer1Bias)
-        layer2Weights = np.array(composite_list[self.numFeatures +
-                                                1:2 * self.numFeatures + 1],
-                                 dtype=object)
-        layer3Weights = np.asmatrix(
-            np.array(composite_list[2 * self.numFeatures + 1:], dtype=object))
-        layer3Weights = layer3Weights.transpose()
+        # The numpy backend is the same network without needing tensorflow, good for cpu only workers
+        self.backend = backend
+        if backend == "numpy":
+            self.network = None
+        elif backend == "keras":
+            keras, Dense = loadKeras()
+            self.network = keras.Sequential([
+                Dense(self.numFeatures, name="layer1", use_bias=True),
+                Dense(self.numFeatures,
+                      activation="selu",
+                      name="layer2",
+                      use_bias=False),
+                Dense(1, name="layer3", use_bias=False)
+            ])
+            init_feature_vector = featureVectorGenerator(Board(), Board())
+            fv = np.asmatrix(init_feature_vector)
+            self.network(fv)
+        else:
+            raise ValueError(f"Unknown network backend: {backend}")
+        self.set_weights(weights)
+        # self.network.summary()
+
+    def set_weights(self, weights) -> None:
+        """
+        Loads a new flat weight vector into the network, so a worker can reuse one agent for many genomes
+        """
+        layer1Weights, layer1Bias, layer2Weights, layer3Weights = unpackNetworkWeights(
+            weights, self.numFeatures)
+        if self.backend == "numpy":
+            self.network = SeluNetwork(layer1Weights, layer1Bias,
+                                       layer2Weights, layer3Weights)
+            return
         self.network.layers[0].set_weights([layer1Weights, layer1Bias])
         self.network.layers[1].set_weights([layer2Weights])
         self.network.layers[2].set_weights([layer3Weights])
-        # self.network.summary()
+
+    def score_features(self, features):
+        # Every afterstate goes through the network in a single batched forward pass
+        if self.backend == "numpy":
+            return self.network(features)[:, 0]
+        return self.network(np.asarray(features, dtype=np.float32)).numpy()[:,
+                                                                            0]
 
     def get_move(self, board, pieces):
-        moves = self.get_all_moves(board, pieces[0])
-        prevBoards = {}
-        for m in moves:
-            prevBoards[board.make_move(pieces[0], m)[0]] = m
-        evaluations = [(self.network(
-            np.asmatrix(self.featureVectorGenerator(b, board))).numpy()[0][0],
-                        move) for b, move in prevBoards.items()]
-        if len(evaluations) == 0:
+        best = best_placement(board, pieces[0], self.score_features,
+                              self.featureMatrixGenerator,
+                              self.get_all_moves(board, pieces[0]))
+        if best is None:
             return None
-        maxEval = max(evaluations, key=lambda x: x[0])[1]
-        return maxEval
+        return best[0]
+
+
+def unpackNetworkWeights(weights, numFeatures) -> tuple:
+    """
+    Splits the flat weight list of a NetworkAgent into its layers
+    The list is read numFeatures at a time: numFeatures rows of layer 1 weights, the layer 1 bias, numFeatures rows of layer 2 weights and the layer 3 weights
+    Returns (layer1 weights, layer1 bias, layer2 weights, layer3 weights) with the shapes keras uses
+    """
+    weights = np.array(weights, dtype=float)
+    if len(weights) != numFeatures * numFeatures * 2 + numFeatures * 2:
+        raise ValueError(
+            f"Expected {numFeatures * numFeatures * 2 + numFeatures * 2} weights, got {len(weights)}"
+        )
+    composite = weights.reshape(-1, numFeatures)
+    layer1Weights = composite[:numFeatures]
+    layer1Bias = composite[numFeatures]
+    layer2Weights = composite[numFeatures + 1:2 * numFeatures + 1]
+    layer3Weights = composite[2 * numFeatures + 1:].transpose()
+    return layer1Weights, layer1Bias, layer2Weights, layer3Weights
+
+
+SELU_ALPHA = 1.6732632423543772848170429916717
+SELU_SCALE = 1.0507009873554804934193349852946
+
+
+class SeluNetwork:
+    """
+    NumPy version of the keras network NetworkAgent builds
+    A linear layer with a bias, a selu layer and a linear output layer, none of the last two have a bias
+    """
+
+    def __init__(self, layer1Weights, layer1Bias, layer2Weights,
+                 layer3Weights) -> None:
+        self.layer1Weights = layer1Weights
+        self.layer1Bias = layer1Bias
+        self.layer2Weights = layer2Weights
+        self.layer3Weights = layer3Weights
+
+    def __call__(self, features) -> np.ndarray:
+        """
+        Takes an (N, F) matrix and returns the (N, 1) outputs
+        """
+        hidden = np.asarray(features,
+                            dtype=float) @ self.layer1Weights + self.layer1Bias
+        hidden = hidden @ self.layer2Weights
+        hidden = SELU_SCALE * np.where(
+            hidden > 0, hidden, SELU_ALPHA * np.expm1(np.minimum(hidden, 0)))
+        return hidden @ self.layer3Weights
 
 
 class NeatAgent(SimpleAgent):
@@ -170,24 +339,29 @@ class NeatAgent(SimpleAgent):
     This agent is a neural network that is trained using NEAT. 
     """
 
-    def __init__(self, featureVectorGenerator, network) -> None:
-        super().__init__()
+    def __init__(self,
+                 featureVectorGenerator,
+                 network,
+                 allowTucks=False) -> None:
+        super().__init__(allowTucks)
         self.network = network
         self.featureVectorGenerator = featureVectorGenerator
+        self.featureMatrixGenerator = getFeatureMatrixGenerator(
+            featureVectorGenerator)
+
+    def score_features(self, features):
+        # The network has a single output node, a compiled network scores every afterstate in one call
+        if hasattr(self.network, "activate_batch"):
+            return self.network.activate_batch(features)[:, 0]
+        return [self.network.activate(xi)[0] for xi in features]
 
     def get_move(self, board, pieces):
-        moves = self.get_all_moves(board, pieces[0])
-        prevBoards = {}
-        for m in moves:
-            prevBoards[board.make_move(pieces[0], m)[0]] = m
-        boards = [(self.featureVectorGenerator(b, board), move)
-                  for b, move in prevBoards.items()]
-        evaluations = [(self.network.activate(xi), move)
-                       for xi, move in boards]
-        if len(evaluations) == 0:
+        best = best_placement(board, pieces[0], self.score_features,
+                              self.featureMatrixGenerator,
+                              self.get_all_moves(board, pieces[0]))
+        if best is None:
             return None
-        maxEval = max(evaluations, key=lambda x: x[0])[1]
-        return maxEval
+        return best[0]
 
 
 class MiniMaxAgent(TetrisAgent):
@@ -211,4 +385,4 @@ def main():
 
 # Main Method
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
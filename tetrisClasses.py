@@ -1,7 +1,7 @@
 from __future__ import annotations
 from typing import Tuple
 
-from constants import BOARD_WIDTH, BOARD_HEIGHT, BLOCK_CHARACTER
+from constants import BOARD_WIDTH, BOARD_HEIGHT, BLOCK_CHARACTER, FULL_ROW
 from dataclasses import dataclass
 from piece import Piece, Rotation
 
@@ -14,11 +14,18 @@ class Move:
 
 
 class Board:
-
-    def __init__(self, matrix: list = None) -> None:
+    """
+    Boards are stored as bitboards, each row is a BOARD_WIDTH bit int where bit x is set if column x is filled.
+    Colors (the piece numbers) live in an optional sparse layer of one {x: color} dict per row.
+    Boards without the color layer report 1 for every filled square
+    Every board also carries its column profile (column heights, holes per column and the highest block)
+    Boards made by make_move derive it from their parent, so the feature getters never have to scan the board
+    """
+
+    def __init__(self, matrix: list = None, trackColors=True) -> None:
         if matrix is None:
-            self._matrix = tuple(
-                tuple([0] * BOARD_WIDTH) for _ in range(BOARD_HEIGHT))
+            self._rows = EMPTY_ROWS
+            self._colors = EMPTY_COLORS if trackColors else None
         else:
             h = len(matrix)
             w = len(matrix[0])
@@ -26,29 +33,105 @@ class Board:
                 raise ValueError(
                     f"Board must be {BOARD_WIDTH}x{BOARD_HEIGHT}, board is {w}x{h}"
                 )
-            self._matrix = tuple(tuple(row) for row in matrix)
-        self._hashMatrix = tuple(
-            [tuple([bool(x) for x in row]) for row in self._matrix])
+            self._rows = tuple(
+                sum(1 << x for x, val in enumerate(row) if val)
+                for row in matrix)
+            if trackColors:
+                self._colors = tuple({
+                    x: val
+                    for x, val in enumerate(row) if val
+                } for row in matrix)
+            else:
+                self._colors = None
+        self._set_profile(*self._scan_profile())
+
+    @classmethod
+    def from_rows(cls, rows, colors=None, profile=None) -> Board:
+        """
+        Builds a board straight from its row bitmasks (and optionally its color layer) without validating anything
+        profile is a (column heights, column holes) pair, it is computed from the rows if not given
+        """
+        board = cls.__new__(cls)
+        board._rows = tuple(rows)
+        board._colors = colors
+        if profile is None:
+            profile = board._scan_profile()
+        board._set_profile(*profile)
+        return board
+
+    def _set_profile(self, heights: tuple, holes: tuple) -> None:
+        self._heights = heights
+        self._holes = holes
+        self._numHoles = sum(holes)
+        self._highest = min(heights)
+
+    def _scan_profile(self) -> tuple:
+        # Computes the column heights and holes of every column in a single pass over the rows
+        heights = [BOARD_HEIGHT] * BOARD_WIDTH
+        holes = [0] * BOARD_WIDTH
+        covered = 0
+        for i, row in enumerate(self._rows):
+            new = row & ~covered
+            while new:
+                low = new & -new
+                heights[low.bit_length() - 1] = i
+                new ^= low
+            covered |= row
+            empty = covered & ~row
+            while empty:
+                low = empty & -empty
+                holes[low.bit_length() - 1] += 1
+                empty ^= low
+        return tuple(heights), tuple(holes)
+
+    def _scan_column(self, rows: list, col: int) -> tuple:
+        # Returns the height and number of holes of a single column of the given rows
+        bit = 1 << col
+        for i, row in enumerate(rows):
+            if row & bit:
+                return i, sum(1 for r in rows[i + 1:] if not r & bit)
+        return BOARD_HEIGHT, 0
+
+    def get_rows(self) -> tuple:
+        return self._rows
+
+    def has_colors(self) -> bool:
+        return self._colors is not None
+
+    def get_colors(self) -> tuple:
+        # The sparse color layer, one {x: color} dict per row, or None
+        return self._colors
 
     def get_square(self, x: int, y: int) -> int:
         if x < 0 or x >= BOARD_WIDTH or y < 0 or y >= BOARD_HEIGHT:
             return None
-        return self._matrix[y][x]
+        if not self._rows[y] >> x & 1:
+            return 0
+        if self._colors is None:
+            return 1
+        return self._colors[y][x]
 
     def get_square_truthy(self, x: int, y: int) -> bool:
-        return self.get_square(x, y) is not None and self.get_square(x, y) > 0
+        if x < 0 or x >= BOARD_WIDTH or y < 0 or y >= BOARD_HEIGHT:
+            return False
+        return bool(self._rows[y] >> x & 1)
 
     def get_row(self, row: int) -> tuple:
-        return self._matrix[row]
+        row = range(BOARD_HEIGHT)[row]
+        return tuple(self.get_square(x, row) for x in range(BOARD_WIDTH))
 
     def get_column(self, col: int) -> tuple:
-        return tuple(row[col] for row in self._matrix)
+        col = range(BOARD_WIDTH)[col]
+        return tuple(self.get_square(col, y) for y in range(BOARD_HEIGHT))
 
     def get_colmn_height(self, col: int) -> int:
-        for i in range(BOARD_HEIGHT):
-            if self.get_square_truthy(col, i):
-                return i
-        return BOARD_HEIGHT
+        return self._heights[col]
+
+    def get_column_heights(self) -> tuple:
+        return self._heights
+
+    def get_column_holes(self) -> tuple:
+        return self._holes
 
     def get_normalized_height(self) -> int:
         return BOARD_HEIGHT - self.get_highest_block()
@@ -56,6 +139,30 @@ class Board:
     def get_normalized_column_height(self, col: int) -> int:
         return BOARD_HEIGHT - self.get_colmn_height(col)
 
+    def _place(self, placement: tuple, y: int) -> tuple:
+        # Returns the rows with the piece placed (before clearing) and the rows it filled
+        # Only the rows the piece landed in can have been filled
+        rows = list(self._rows)
+        linesToRemove = []
+        for yOff, mask in placement:
+            row = rows[y + yOff] | mask
+            rows[y + yOff] = row
+            if row == FULL_ROW:
+                linesToRemove.append(y + yOff)
+        return rows, linesToRemove
+
+    def get_afterstate_rows(self, piece: Piece, move: Move) -> list:
+        """
+        Returns the rows of the board make_move would return, without building that board
+        """
+        rows, linesToRemove = self._place(
+            piece.get_rotation(move.rotation).placementMasks[move.x], move.y)
+        if linesToRemove:
+            rows = [0] * len(linesToRemove) + [
+                row for i, row in enumerate(rows) if i not in linesToRemove
+            ]
+        return rows
+
     def make_move(self,
                   piece: Piece,
                   move: Move,
@@ -64,88 +171,107 @@ class Board:
         Returns tuple of newBoard, lines cleared
         This function does not validate the move, will throw errors
         """
-        newMatrix = list(list(row) for row in self._matrix)
         rot = piece.get_rotation(move.rotation)
-        for xOff in range(4):
-            for yOff in range(4):
-                if rot.get_pos(xOff, yOff):
-                    newMatrix[move.y + yOff][move.x + xOff] = piece.number
-        # We need to remove cleared rows now
-        linesToRemove = []
-        for i in range(BOARD_HEIGHT):
-            if all(newMatrix[i]):
-                linesToRemove.append(i)
-        for i in linesToRemove:
-            newMatrix.pop(i)
-            newMatrix.insert(0, [0] * BOARD_WIDTH)
+        placement = rot.placementMasks[move.x]
+        rows, linesToRemove = self._place(placement, move.y)
+        colors = self._colors
+        if colors is not None:
+            colors = list(colors)
+            for yOff, mask in placement:
+                rowColors = dict(colors[move.y + yOff])
+                while mask:
+                    low = mask & -mask
+                    rowColors[low.bit_length() - 1] = piece.number
+                    mask ^= low
+                colors[move.y + yOff] = rowColors
+        # Only the columns the piece touched change their profile, unless lines were cleared
+        heights = list(self._heights)
+        holes = list(self._holes)
+        for colOff, topOff, numBlocks in rot.columnSpans:
+            col = move.x + colOff
+            height = heights[col]
+            top = min(height, move.y + topOff)
+            # Every empty square between the old and new top becomes a hole, a block placed below the old top fills one
+            holes[col] += height - top - numBlocks
+            heights[col] = top
+        if linesToRemove:
+            numLines = len(linesToRemove)
+            rows = [0] * numLines + [
+                row for i, row in enumerate(rows) if i not in linesToRemove
+            ]
+            if colors is not None:
+                colors = [{}] * numLines + [
+                    c for i, c in enumerate(colors) if i not in linesToRemove
+                ]
+            # Cleared rows are full so they are all at or below the top of every column
+            # Columns whose top block was cleared get rescanned, the rest just move down
+            for col in range(BOARD_WIDTH):
+                if heights[col] in linesToRemove:
+                    heights[col], holes[col] = self._scan_column(rows, col)
+                else:
+                    heights[col] += numLines
+        newBoard = Board.from_rows(rows,
+                                   None if colors is None else tuple(colors),
+                                   (tuple(heights), tuple(holes)))
         if scoringByLines:
-            return Board(newMatrix), len(linesToRemove)
+            return newBoard, len(linesToRemove)
         else:  # Simple enough to reward
-            return Board(newMatrix), len(linesToRemove) * len(linesToRemove)
+            return newBoard, len(linesToRemove) * len(linesToRemove)
 
     def get_board_sum(self):
-        return sum(sum(row) for row in self._matrix)
+        if self._colors is None:
+            return self.get_num_blocks()
+        return sum(sum(row.values()) for row in self._colors)
 
     def get_highest_block(self) -> int:
         # Returns the row number of the highest block
         # Reminder that lower numbers are actually higher blocks since the 0,0 is upper left
-        for i in range(BOARD_HEIGHT):
-            if any(self.get_row(i)):
-                return i
-        return BOARD_HEIGHT
+        return self._highest
 
     def get_num_holes(self) -> int:
-        total = 0
-        for col in range(BOARD_WIDTH):
-            c = self.get_column(col)
-            found_block = False
-
-            for i in range(BOARD_HEIGHT):
-                if c[i] != 0:
-                    found_block = True
-                if found_block and c[i] == 0:
-                    total += 1
-        return total
+        return self._numHoles
 
     def get_bumpiness(self) -> int:
+        heights = self._heights
         total = 0
         for i in range(1, BOARD_WIDTH):
-            total += abs(
-                self.get_colmn_height(i) - self.get_colmn_height(i - 1))
+            total += abs(heights[i] - heights[i - 1])
         return total
 
     def get_aggregate_height(self) -> int:
-        return sum(
-            self.get_normalized_column_height(i) for i in range(BOARD_WIDTH))
+        return BOARD_WIDTH * BOARD_HEIGHT - sum(self._heights)
 
     def is_lost(self) -> bool:
-        return self.get_highest_block() == 0
+        return self._highest == 0
 
     def get_num_pits(self) -> int:
-        total = 0
-        for i in range(BOARD_WIDTH):
-            if self.get_normalized_column_height(i) == 0:
-                total += 1
-        return total
+        return self._heights.count(BOARD_HEIGHT)
 
     def get_num_row_transitions(self):
-        total = 0
-        for i in range(BOARD_WIDTH):
-            for j in range(BOARD_HEIGHT - 1):
-                if self.get_square(i, j) != self.get_square(i, j + 1):
-                    total += 1
+        # Counts the changes between vertically adjacent squares, like get_square two filled squares of different colors are a change
+        rows = self._rows
+        total = sum((rows[j] ^ rows[j + 1]).bit_count()
+                    for j in range(BOARD_HEIGHT - 1))
+        if self._colors is not None:
+            for above, below in zip(self._colors, self._colors[1:]):
+                total += sum(1 for x, color in above.items()
+                             if below.get(x, color) != color)
         return total
 
     def get_num_column_transitions(self):
+        # This keeps the indexing of the original matrix version, which walks x over BOARD_HEIGHT - 1 columns and y over BOARD_WIDTH rows
+        # So it counts the horizontal changes within the top BOARD_WIDTH rows, and the right wall (None) always counts as one change per row
         total = 0
-        for i in range(BOARD_HEIGHT - 1):
-            for j in range(BOARD_WIDTH):
-                if self.get_square(i, j) != self.get_square(i + 1, j):
-                    total += 1
+        for row in self._rows[:BOARD_WIDTH]:
+            total += ((row ^ (row >> 1)) & (FULL_ROW >> 1)).bit_count() + 1
+        if self._colors is not None:
+            for colors in self._colors[:BOARD_WIDTH]:
+                total += sum(1 for x, color in colors.items()
+                             if colors.get(x + 1, color) != color)
         return total
 
     def get_num_blocks(self) -> int:
-        return sum(sum(row) for row in self._hashMatrix)
+        return sum(row.bit_count() for row in self._rows)
 
     def __repr__(self) -> str:
 
@@ -153,14 +279,26 @@ class Board:
             return "".join([str(x) for x in line])
             return "".join([BLOCK_CHARACTER if x else "_" for x in line])
 
-        return "\n".join(convertLineToString(line) for line in self._matrix)
+        return "\n".join(
+            convertLineToString(self.get_row(y)) for y in range(BOARD_HEIGHT))
 
     def __hash__(self) -> int:
         # Boards are the same if their matrix is the same based on booleans, not colors
-        return hash(self._hashMatrix)
+        return hash(self._rows)
 
     def __eq__(self, other: Board) -> bool:
-        return self._matrix == other._matrix
+        if self._rows != other._rows:
+            return False
+        if self._colors is None or other._colors is None:
+            # A board without colors only matches one whose every square has color 1
+            return all(
+                self.get_row(y) == other.get_row(y)
+                for y in range(BOARD_HEIGHT))
+        return self._colors == other._colors
+
+
+EMPTY_ROWS = (0, ) * BOARD_HEIGHT
+EMPTY_COLORS = tuple({} for _ in range(BOARD_HEIGHT))
 
 
 @dataclass(frozen=True)
@@ -168,4 +306,4 @@ class TetrisPlacementState:
     board: Board
     x: int
     y: int
-    rotation: Rotation
\ No newline at end of file
+    rotation: Rotation
@@ -1,26 +1,55 @@
+from __future__ import annotations
 from piece import Piece, Rotation, PIECES, get_random_piece, hero, smashboy, clevelandZ, teeWee, rhodeIslandZ, blueRicky
 import random
 
+PIECES_BY_NUMBER = {p.number: p for p in PIECES}
+
 
 class TetrisPieceGenerator:
     """
     Generator which manages the creation of tetris pieces as an infinite stream. 
     Notably follows tetris rules in that batches of 7 are shuffled and then all picked before they are reset.
+    Given a seed the generator has its own random number generator, so the same seed always gives the same pieces
     """
 
-    def __init__(self) -> None:
-        self.current = list(PIECES)
-        random.shuffle(self.current)
+    def __init__(self, seed=None) -> None:
+        if seed is None:
+            self.random = random
+            self.pieces = list(PIECES)
+        else:
+            # PIECES is a set whose order can change between processes, so seeded bags start from a fixed order
+            self.random = random.Random(seed)
+            self.pieces = sorted(PIECES, key=lambda p: p.number)
+        self.current = list(self.pieces)
+        self.random.shuffle(self.current)
 
     def __next__(self) -> Piece:
         if len(self.current) == 0:
-            self.current = list(PIECES)
-            random.shuffle(self.current)
+            self.current = list(self.pieces)
+            self.random.shuffle(self.current)
         return self.current.pop()
 
 
+class SequencePieceGenerator:
+    """
+    Plays back a materialized sequence of piece numbers, the array is only read so it can live in shared memory
+    """
+
+    def __init__(self, sequence) -> None:
+        self.sequence = sequence
+        self.index = 0
+
+    def __next__(self) -> Piece:
+        if self.index >= len(self.sequence):
+            raise IndexError(
+                "Ran out of pieces, materialize longer piece sequences")
+        piece = PIECES_BY_NUMBER[int(self.sequence[self.index])]
+        self.index += 1
+        return piece
+
+
 #main method
 if __name__ == "__main__":
     gen = TetrisPieceGenerator()
     for i in range(10):
-        print(next(gen))
\ No newline at end of file
+        print(next(gen))
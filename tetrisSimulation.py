@@ -1,17 +1,41 @@
 import logging
-from tkinter import scrolledtext
 from typing import Tuple, List
 from logging import getLogger
-import neat
 import pickle
+import numpy as np
 
+from constants import BOARD_WIDTH
 from tetrisClasses import Board, Piece, Move, TetrisPlacementState
-from tetrisUtilities import get_all_drop_moves, get_all_drop_boards, is_state_legal, is_state_goal, generate_boards_from_pieces
+from tetrisUtilities import get_all_drop_moves, get_all_drop_boards, is_state_legal, is_state_goal, generate_boards_from_pieces, packAfterstates, drop_afterstates, move_order, DROP_CLEARANCE, DROP_TABLES
 from piece import Piece, Rotation, PIECES
 from tetrisAgent import DepthAgent, NeatAgent, NetworkAgent, TetrisAgent, SimpleAgent
-from tetrisPieceGenerator import TetrisPieceGenerator
-from hueristics import aggregateHeightHueristic, maxHeightHueristic, customHueristic, featureVector, originalFeatureVector
+from tetrisPieceGenerator import TetrisPieceGenerator, SequencePieceGenerator
+from neatCompiler import CompiledNetwork
+from hueristics import aggregateHeightHueristic, maxHeightHueristic, customHueristic, featureVector, originalFeatureVector, getFeatureMatrixGenerator, packBoards, packSquares
 from myLogger import getModuleLogger
+from gameRecord import GameRecord, GameStep
+
+# neat is only imported inside the functions that need it, so the simulation can be imported without it
+
+# Official points from level 1 for clearing 0 to 4 rows at once
+OFFICIAL_SCORES = (0, 40, 100, 300, 1200)
+
+
+def scoreClear(rowsCleared: int, scoringType="lines") -> int:
+    """
+    Returns the points for clearing rowsCleared rows with a single piece
+    """
+    if scoringType == "lines":  # If we are scoring by lines cleared
+        return rowsCleared
+    if scoringType == 'squared':  # Squares the numbers of rows cleared
+        return rowsCleared * rowsCleared
+    if scoringType == 'tetris':  # Focuses on tetris, no benefit for anything but tetris
+        if rowsCleared == 4:
+            return 16
+        return rowsCleared
+    if scoringType == "official":  # Uses the official scoring from lvl 1
+        return OFFICIAL_SCORES[rowsCleared]
+    return 0
 
 
 class TetrisSimulation:
@@ -20,47 +44,45 @@ class TetrisSimulation:
     Goal: Simulate a game given an agent and export a series of moves
     """
 
-    def __init__(self, agent: TetrisAgent, numKnownPieces=3) -> None:
+    def __init__(self,
+                 agent: TetrisAgent,
+                 numKnownPieces=3,
+                 trackColors=True,
+                 seed=None) -> None:
         self.logger = getModuleLogger(__name__, logging.INFO)
         if numKnownPieces < 1:
             raise ValueError("Must have at least one known piece")
-        self.board = Board()
+        # The transition features count changes between piece colors, so trackColors=False changes what agents see
+        self.trackColors = trackColors
+        self.board = Board(trackColors=trackColors)
         self.score = 0
         self.game_over = False
         self.agent = agent
         self.numKnownPieces = numKnownPieces
-        self.pieceGenerator = TetrisPieceGenerator()
+        # With a seed the pieces are the same every time the simulation is made, so a game can be stored as just its moves
+        self.seed = seed
+        self.pieceGenerator = TetrisPieceGenerator(seed)
         self.knownPieces = [
             next(self.pieceGenerator) for _ in range(numKnownPieces)
         ]
         self.logger.debug(f"Created TetrisSimulation")
 
-    def playGame(
-        self,
-        max_moves=300,
-        scoringType="lines"
-    ) -> Tuple[Board, int, bool, List[Board], List[Move], List[Piece], int]:
+    def steps(self, max_moves=300, scoringType="lines"):
         """
-        Simulates a single game of tetris based on the given agent, and returns the final score
-        Currently score is calculated as the number of rows cleared
+        Plays a single game of tetris based on the given agent, yielding a GameStep after every piece is placed
+        The pieces are only played as the steps are asked for, self.score and self.game_over are up to date at every step
         """
         self.logger.debug(f"Simulating a game of Tetris")
-        # Make sure that we are playing on an empty board
-        if (self.board.get_board_sum() != 0):
-            self.board = Board()
-        assert (self.board.get_board_sum() == 0)  # Makes sure board is empty
         self.score = 0  # Reset score
         self.game_over = False  # Reset game over
-        self.board = Board()  # Reset board
+        self.board = Board(trackColors=self.trackColors)  # Reset board
         numMoves = 0
-        linesCleared = 0
-        boards = []
-        pieces = []
-        moves = []
+        debug = self.logger.isEnabledFor(logging.DEBUG)
 
         while not self.game_over and numMoves < max_moves:
-            self.logger.debug("-----------------------------")
-            self.logger.debug("\n" + str(self.board))
+            if debug:
+                self.logger.debug("-----------------------------")
+                self.logger.debug("\n" + str(self.board))
             # self.logger.debug("Bumpiness: " + str(self.board.get_bumpiness()))
             # self.logger.debug("Holes: " + str(self.board.get_num_holes()))
             move = self.agent.get_move(self.board, self.knownPieces)
@@ -72,38 +94,53 @@ class TetrisSimulation:
             # We update the board and grab the number of rows cleared
             self.board, rowsCleared = self.board.make_move(
                 self.knownPieces[0], move)
-            moves = moves + [move]
-            boards = boards + [self.board]
-            pieces = pieces + [self.knownPieces[0]]
             # Then we get rid of the pice we just played
-            self.knownPieces.pop(0)
+            piece = self.knownPieces.pop(0)
             # Add the next piece
             self.knownPieces.append(next(self.pieceGenerator))
             # And then add to the score
-            if scoringType == "lines":  # If we are scoring by lines cleared
-                self.score += rowsCleared
-            if scoringType == 'squared':  # Squares the numbers of rows cleared
-                self.score += rowsCleared * rowsCleared
-            if scoringType == 'tetris':  # Focuses on tetris, no benefit for anything but tetris
-                if rowsCleared == 4:
-                    self.score += 16
-                else:
-                    self.score += rowsCleared
-            if scoringType == "official":  # Uses the official scoring from lvl 1
-                if rowsCleared == 4:
-                    self.score += 1200
-                elif rowsCleared == 3:
-                    self.score += 300
-                elif rowsCleared == 2:
-                    self.score += 100
-                elif rowsCleared == 1:
-                    self.score += 40
-            linesCleared += rowsCleared
+            self.score += scoreClear(rowsCleared, scoringType)
 
             # This we check if the game is over
             if self.isGameOver():
                 self.game_over = True
             numMoves += 1
+            yield GameStep(self.board, piece, move, rowsCleared)
+
+    def playGame(
+        self,
+        max_moves=300,
+        scoringType="lines",
+        record="full"
+    ) -> Tuple[Board, int, bool, List[Board], List[Move], List[Piece], int]:
+        """
+        Simulates a single game of tetris based on the given agent, and returns the final score
+        Currently score is calculated as the number of rows cleared
+        record picks how much of the game is kept:
+        "full" returns every board, move and piece, "compact" returns a GameRecord of two bytes per step in place of the moves
+        (boards and pieces are None), and "none" keeps nothing so memory stays the same however long the game is
+        """
+        if record not in ("full", "compact", "none"):
+            raise ValueError(f"Unknown record mode {record}")
+        linesCleared = 0
+        boards = pieces = None
+        if record == "full":
+            boards = []
+            pieces = []
+            moves = []
+        elif record == "compact":
+            moves = GameRecord()
+        else:
+            moves = None
+
+        for step in self.steps(max_moves, scoringType):
+            if record == "full":
+                moves.append(step.move)
+                boards.append(step.board)
+                pieces.append(step.piece)
+            elif record == "compact":
+                moves.append(step.piece, step.move)
+            linesCleared += step.rowsCleared
 
         # Return the final board and score
         return self.board, self.score, not self.game_over, boards, moves, pieces, linesCleared
@@ -117,6 +154,248 @@ class TetrisSimulation:
         return self.board.get_highest_block() == 0
 
 
+class VectorTetrisSimulation:
+    """
+    Plays numGames games with the same agent in lockstep
+    The games are packed into arrays: rows (numGames, BOARD_HEIGHT) row bitmasks, heights (numGames, BOARD_WIDTH) column heights
+    and squares (numGames, BOARD_HEIGHT, BOARD_WIDTH) square values when colors are kept
+    Every step the games that drop their piece are grouped by piece and their candidates are generated from the packed arrays at once (drop_afterstates),
+    then the placements of all the games are featurized and scored together in one batch,
+    so an agent with score_features (FeatureAgent, NetworkAgent, NeatAgent) makes one scoring call per step instead of one per game
+    Games whose agent can tuck, or whose stack is too high for a plain drop, get their candidates from the agent one game at a time
+    Agents without score_features fall back to get_move for each game
+    The Board of every game is kept too, only the chosen placement is ever made into one
+    """
+
+    def __init__(self,
+                 agent: TetrisAgent,
+                 numGames=5,
+                 numKnownPieces=3,
+                 trackColors=True,
+                 seeds=None,
+                 pieceSequences=None) -> None:
+        self.logger = getModuleLogger(__name__, logging.INFO)
+        if numKnownPieces < 1:
+            raise ValueError("Must have at least one known piece")
+        if seeds is not None and len(seeds) != numGames:
+            raise ValueError("Need one piece seed per game")
+        if pieceSequences is not None and len(pieceSequences) != numGames:
+            raise ValueError("Need one piece sequence per game")
+        self.agent = agent
+        self.numGames = numGames
+        self.numKnownPieces = numKnownPieces
+        self.trackColors = trackColors
+        # With seeds every reset replays the same piece sequences, game i uses seeds[i]
+        self.seeds = seeds
+        # Or every game plays back a materialized sequence of piece numbers, which can be a SharedPieceSequences
+        self.pieceSequences = pieceSequences
+        self.batched = hasattr(agent, "score_features") and hasattr(
+            agent, "featureMatrixGenerator")
+        if self.batched:
+            self.featureMatrixGenerator = agent.featureMatrixGenerator
+        # Only the plain drop moves of SimpleAgent can be generated from the packed arrays
+        self.dropsOnly = (isinstance(agent, SimpleAgent)
+                          and not agent.allowTucks
+                          and type(agent).get_all_moves
+                          is SimpleAgent.get_all_moves)
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Starts every game over on an empty board with its own piece queue
+        """
+        self.boards = [
+            Board(trackColors=self.trackColors) for _ in range(self.numGames)
+        ]
+        self.rows = packBoards(self.boards)
+        self.heights = np.array([b.get_column_heights() for b in self.boards],
+                                dtype=np.intp).reshape(-1, BOARD_WIDTH)
+        self.squares = packSquares(self.boards) if self.trackColors else None
+        if self.pieceSequences is not None:
+            self.pieceGenerators = [
+                SequencePieceGenerator(sequence)
+                for sequence in self.pieceSequences
+            ]
+        else:
+            seeds = self.seeds
+            if seeds is None:
+                seeds = [None] * self.numGames
+            self.pieceGenerators = [
+                TetrisPieceGenerator(seed) for seed in seeds
+            ]
+        self.knownPieces = [[next(g) for _ in range(self.numKnownPieces)]
+                            for g in self.pieceGenerators]
+        self.scores = np.zeros(self.numGames, dtype=int)
+        self.linesCleared = np.zeros(self.numGames, dtype=int)
+        self.numMoves = np.zeros(self.numGames, dtype=int)
+        self.gameOver = np.zeros(self.numGames, dtype=bool)
+        self.done = np.zeros(self.numGames, dtype=bool)
+
+    def candidates(self, games: list) -> list:
+        """
+        Generates the placements of the next piece of the given games as (games, moves, afterstates) blocks
+        A block has K placements per game packed like packAfterstates, game games[j] has rows j * K to (j + 1) * K
+        moves is the list of moves of a single game, or the DropTable and (len(games), K) landing rows of a batch of drops
+        """
+        drops = {}
+        blocks = []
+        for i in games:
+            if self.dropsOnly and self.heights[i].min() >= DROP_CLEARANCE:
+                drops.setdefault(self.knownPieces[i][0], []).append(i)
+                continue
+            board, piece = self.boards[i], self.knownPieces[i][0]
+            moves = sorted(self.agent.get_all_moves(board, piece),
+                           key=move_order)
+            blocks.append(([i], moves, packAfterstates(board, piece, moves)))
+        for piece, group in drops.items():
+            ys, afterstates = drop_afterstates(
+                self.rows[group], self.heights[group], piece,
+                None if self.squares is None else self.squares[group])
+            blocks.append(
+                (group, (DROP_TABLES[piece.number], ys),
+                 afterstates.reshape((-1, ) + afterstates.shape[2:])))
+        return blocks
+
+    def choose_moves(self, games: list) -> list:
+        """
+        Returns the (move, packed afterstate) each of the given games plays next, None for games with no legal placement
+        The afterstate is None when the agent picked the move itself
+        """
+        if not self.batched:
+            moves = [
+                self.agent.get_move(self.boards[i], self.knownPieces[i])
+                for i in games
+            ]
+            return [None if m is None else (m, None) for m in moves]
+        blocks = self.candidates(games)
+        order = []
+        counts = []
+        for group, _, afterstates in blocks:
+            order.extend(group)
+            counts.extend([len(afterstates) // len(group)] * len(group))
+        if sum(counts) == 0:
+            return [None] * len(games)
+        prevBoards = [
+            self.boards[i] for i, count in zip(order, counts)
+            for _ in range(count)
+        ]
+        afterstates = np.concatenate([block[2] for block in blocks])
+        scores = self.score_placements(
+            self.featureMatrixGenerator(afterstates, prevBoards), order,
+            np.array(counts))
+        chosen = {}
+        start = 0
+        for group, moves, block in blocks:
+            count = len(block) // len(group)
+            for j, i in enumerate(group):
+                if count == 0:
+                    chosen[i] = None
+                    continue
+                k = int(np.argmax(scores[start:start + count]))
+                if isinstance(moves, list):
+                    move = moves[k]
+                else:
+                    table, ys = moves
+                    move = table.move(k, ys[j, k])
+                chosen[i] = (move, afterstates[start + k])
+                start += count
+        return [chosen[i] for i in games]
+
+    def score_placements(self, features, games: list,
+                         counts: np.ndarray) -> np.ndarray:
+        """
+        Scores the (N, F) features of the placements of the given games, counts[k] rows belong to games[k]
+        """
+        return self.agent.score_features(features)
+
+    def step(self, scoringType="lines", max_moves=300) -> np.ndarray:
+        """
+        Plays one piece in every game that is not done and returns the rows each game cleared
+        """
+        rowsCleared = np.zeros(self.numGames, dtype=int)
+        games = [i for i in range(self.numGames) if not self.done[i]]
+        for i, choice in zip(games, self.choose_moves(games)):
+            if choice is None:
+                self.gameOver[i] = True
+                self.done[i] = True
+                continue
+            move, afterstate = choice
+            pieces = self.knownPieces[i]
+            board, rowsCleared[i] = self.boards[i].make_move(pieces[0], move)
+            self.boards[i] = board
+            self.rows[i] = board.get_rows()
+            self.heights[i] = board.get_column_heights()
+            if self.squares is not None:
+                # The chosen afterstate already has the squares of the new board
+                self.squares[i] = packSquares(
+                    [board])[0] if afterstate is None else afterstate
+            pieces.pop(0)
+            pieces.append(next(self.pieceGenerators[i]))
+            self.scores[i] += scoreClear(rowsCleared[i], scoringType)
+            self.linesCleared[i] += rowsCleared[i]
+            self.numMoves[i] += 1
+            if board.get_highest_block() == 0:
+                self.gameOver[i] = True
+            self.done[i] = self.gameOver[i] or self.numMoves[i] >= max_moves
+        return rowsCleared
+
+    def playGames(self, max_moves=300, scoringType="lines") -> list:
+        """
+        Plays all the games to the end, same rules as TetrisSimulation.playGame
+        Returns (final board, score, survived, lines cleared) for each game
+        """
+        self.reset()
+        while not self.done.all():
+            self.step(scoringType, max_moves)
+        return [(self.boards[i], int(self.scores[i]), not self.gameOver[i],
+                 int(self.linesCleared[i])) for i in range(self.numGames)]
+
+
+class LinearPopulationSimulation(VectorTetrisSimulation):
+    """
+    Plays numGames games for every weight vector of a linear population at once
+    Game k belongs to genome k // numGames and uses the piece seed seeds[k % numGames], so every genome sees the same pieces
+    Each step the features of every placement in every live game are dotted with the weights of the genome that game belongs to,
+    finished games drop out of the batch
+    """
+
+    def __init__(self,
+                 featureVectorGenerator,
+                 population,
+                 numGames=5,
+                 seeds=None,
+                 numKnownPieces=1,
+                 allowTucks=False) -> None:
+        self.weights = np.asarray(population, dtype=float)
+        self.numGenomes = len(self.weights)
+        self.gamesPerGenome = numGames
+        if seeds is not None:
+            if len(seeds) != numGames:
+                raise ValueError("Need one piece seed per game")
+            seeds = list(seeds) * self.numGenomes
+        # The agent only generates the moves, scoring is done for the whole population here
+        super().__init__(SimpleAgent(allowTucks),
+                         numGames=self.numGenomes * numGames,
+                         numKnownPieces=numKnownPieces,
+                         seeds=seeds)
+        self.batched = True
+        self.featureMatrixGenerator = getFeatureMatrixGenerator(
+            featureVectorGenerator)
+
+    def score_placements(self, features, games: list,
+                         counts: np.ndarray) -> np.ndarray:
+        owners = np.repeat(np.array(games) // self.gamesPerGenome, counts)
+        return (features * self.weights[owners]).sum(axis=1)
+
+    def evaluate(self, max_moves=300, scoringType="lines") -> np.ndarray:
+        """
+        Plays all the games and returns the average score of every genome
+        """
+        self.playGames(max_moves, scoringType)
+        return self.scores.reshape(self.numGenomes,
+                                   self.gamesPerGenome).mean(axis=1)
+
+
 def testNetworkAgent():
     logger = getModuleLogger(__name__)
     nnAgent = NetworkAgent(
@@ -195,7 +474,7 @@ def testNetworkAgent():
 
 def eval_single_genome(genome, config):
     total = 0
-    net = neat.nn.FeedForwardNetwork.create(genome, config)
+    net = CompiledNetwork.create(genome, config)
     for i in range(10):
         agent = NeatAgent(featureVector, net)
         sim = TetrisSimulation(agent)
@@ -208,11 +487,13 @@ def eval_single_genome(genome, config):
 
 
 def eval_genomes(genomes, config):
+    import neat
     evaluator = neat.ParallelEvaluator(16, eval_single_genome)
     evaluator.evaluate(genomes, config)
 
 
 def generateNeatAgentFromCheckpoint(file: str, outputFile: str):
+    import neat
     logger = getModuleLogger(__name__)
     logger.info("Loading checkpoint")
     checkpoint = neat.Checkpointer.restore_checkpoint(file)
@@ -227,6 +508,7 @@ def generateNeatAgentFromCheckpoint(file: str, outputFile: str):
 
 
 def testNeatAgent(genomePickleFile: str):
+    import neat
     # Load Genome from file using pickle
     with open(genomePickleFile, "rb") as f:
         genome = pickle.load(f)
@@ -234,7 +516,7 @@ def testNeatAgent(genomePickleFile: str):
     config = neat.Config(neat.DefaultGenome, neat.DefaultReproduction,
                          neat.DefaultSpeciesSet, neat.DefaultStagnation,
                          "tetrisagentconfig")
-    net = neat.nn.FeedForwardNetwork.create(genome, config)
+    net = CompiledNetwork.create(genome, config)
     logger = getModuleLogger(__name__)
     logger.info("Testing neat agent")
     agent = NeatAgent(featureVector, net)
@@ -252,4 +534,4 @@ def testNeatAgent(genomePickleFile: str):
 
 if __name__ == "__main__":
     # generateNeatAgentFromCheckpoint("neat-checkpoint-95", "neat-agent-95.pkl")
-    testNeatAgent("neat-agent-95.pkl")
\ No newline at end of file
+    testNeatAgent("neat-agent-95.pkl")
@@ -1,87 +1,142 @@
-from queue import Queue
-import tqdm
+import numpy as np
 
 from tetrisClasses import Board, Piece, Move, TetrisPlacementState
-from piece import Piece, Rotation
-from constants import BOARD_WIDTH, BOARD_HEIGHT, BLOCK_CHARACTER
+from piece import Piece, Rotation, PIECES
+from constants import BOARD_WIDTH, BOARD_HEIGHT, BLOCK_CHARACTER, FULL_ROW
+from hueristics import featureMatrix, packSquares
+
+# Piece positions are stored as bitsets over x, bit x + X_OFFSET being the piece at x
+# The leftmost legal x is -3, when the piece only uses the last column of its matrix
+X_OFFSET = 3
+ALL_POSITIONS = (1 << (BOARD_WIDTH + X_OFFSET)) - 1
+# Board rows are shifted by X_OFFSET and get the walls on both sides filled in
+WALLS = (1 << X_OFFSET) - 1 | ((1 << 4) - 1) << (BOARD_WIDTH + X_OFFSET)
+FLOOR = (1 << (BOARD_WIDTH + X_OFFSET + 4)) - 1
 
 
 def get_all_legal_moves(
     b: Board,
     piece: Piece,
-) -> list:
+) -> set:
     """
     Given a board and a piece, return all legal moves
+    This finds every resting spot the piece can reach from its spawn by rotating, moving left and right and moving down
+    So unlike get_all_drop_moves it includes tucks and slides under overhangs
+    Moves of duplicate rotations are returned as the unique rotation that places the same blocks
     """
-    # So what we want to do here is generate all legal moves given a board and a piece
-    # This will be accomplished by performing a BFS and returning all legal moves
-    # Moves in this situation are simply (x, y, r) where x and y are the coordinates of the piece and r is the final rotation index
+    # Rather than doing a BFS over (x, y, rotation) states we go down the board one row at a time
+    # For every row and rotation we keep the bitset of x positions that are reachable, and the bitset of x positions that are legal
+    # Within a row the piece can move left, right and rotate as much as it wants, so we flood fill until nothing changes
+    # Then everything reachable that can also be one row lower is carried down to the next row
+    # So we get to cheat here, the piece starts only 4 above the highest block
+    # We always start at rotation 0, but allow the piece to be rotated to any valid position
+    rows = b.get_rows()
+    extRows = [(row << X_OFFSET) | WALLS for row in rows]
+    rotations = [piece.get_rotation(i) for i in range(4)]
+
+    def legal_positions(y):
+        legal = []
+        for rot in rotations:
+            blocked = 0
+            for xOff, yOff in rot.cells:
+                if y + yOff < BOARD_HEIGHT:
+                    blocked |= extRows[y + yOff] >> xOff
+                else:
+                    blocked |= FLOOR
+            legal.append(~blocked & ALL_POSITIONS)
+        return legal
 
-    # States are stored in dataclasses (we don't need to store the piece since it is constant accross the entire bfs)
-    # We will need to be able to check if a given state is legal
-    # We will also need to be able to check if a given state is a goal state
-    # In order to check if a state is legal  we can check to see if any of the current pieces blocks are off the screen or if they intersect with any of the pieces on the board
     moves = set()
-    visited = set()
-    queue = Queue()
-    # So we get to cheat here, when we generate all legal moves from a state, we can start only 4 above the highest block
-    # This cuts out a huge portion of the bfs that is basically useless. Starting 4 above => subtacting 5
-    # We always start at rotation 0, but allow the piece to be rotated to any valid position
-    queue.put(
-        TetrisPlacementState(b, BOARD_WIDTH // 2 - 2,
-                             max(b.get_highest_block() - 5, 0), 0))
-    while not queue.empty():
-        state: TetrisPlacementState = queue.get()
-        # Check to see if we have already been here
-        if state in visited:
-            continue
-        visited.add(state)
-        # Check to see if the state is legal (ie no overlapping or off board squares)
-        if not is_state_legal(state, piece):
-            continue  # If the state is not legal, we can skip it
-        # Checking to see if we should add this to the list of possible moves
-        if is_state_goal(state, piece):
-            moves.add((state.x, state.y, state.rotation))
-        # Here we deal with all of the rotations of the piece
-        for rotationIndex in range(4):
-            if state.rotation != rotationIndex:
-                new_state = TetrisPlacementState(state.board, state.x, state.y,
-                                                 rotationIndex)
-                queue.put(new_state)
-        queue.put(
-            TetrisPlacementState(state.board, state.x + 1, state.y,
-                                 state.rotation))  # Move right
-        queue.put(
-            TetrisPlacementState(state.board, state.x - 1, state.y,
-                                 state.rotation))  # Move Left
-        queue.put(
-            TetrisPlacementState(state.board, state.x, state.y + 1,
-                                 state.rotation))  # Move down
+    y = max(b.get_highest_block() - 5, 0)
+    legal = legal_positions(y)
+    reach = [(1 << (BOARD_WIDTH // 2 - 2 + X_OFFSET)) & legal[0], 0, 0, 0]
+    while any(reach):
+        # Flood fill the row
+        changed = True
+        while changed:
+            changed = False
+            anyRotation = 0
+            for r in range(4):
+                seed = reach[r]
+                while True:
+                    grown = seed | ((seed << 1) | (seed >> 1)) & legal[r]
+                    if grown == seed:
+                        break
+                    seed = grown
+                reach[r] = seed
+                anyRotation |= seed
+            for r in range(4):
+                rotated = reach[r] | (anyRotation & legal[r])
+                if rotated != reach[r]:
+                    reach[r] = rotated
+                    changed = True
+        # Anything that can not move down any further is a resting spot
+        below = legal_positions(y + 1) if y + 1 < BOARD_HEIGHT else [0] * 4
+        for r in range(4):
+            resting = reach[r] & ~below[r]
+            original, xShift, yShift = piece.duplicateOf[r]
+            while resting:
+                low = resting & -resting
+                x = low.bit_length() - 1 - X_OFFSET
+                moves.add(Move(x + xShift, y + yShift, original))
+                resting ^= low
+        reach = [reach[r] & below[r] for r in range(4)]
+        legal = below
+        y += 1
     return moves
 
 
-def get_all_drop_moves(b: Board, piece: Piece):
+def drop_placements(b: Board, piece: Piece):
     """
-    This function is very similar to the above one, but rather than performing a bfs to find all of the more unique moves it simply drops the pieces in every single orientation from every legal position. 
-    This generates all legal moves that would involve rotating, moving and the dropping the piece
+    Generates every (x, y, rotation) reached by rotating, moving and then hard dropping the piece
+    Instead of stepping the piece down one row at a time, the landing row is computed directly from the board's column heights and the bottom contour of the piece
     """
-    moves = set()
+    heights = b.get_column_heights()
+    startY = b.get_highest_block() - 5
+    if startY < 0:
+        # The piece starts in the top row and may already overlap blocks, this only happens when the game is nearly lost
+        yield from _clamped_drop_placements(b, piece)
+        return
+    # Starting 4 above the highest block means the whole piece starts above every block
+    # So it falls until one of its columns lands on top of the matching board column
+    # Duplicate rotations would only give the same boards again
+    for i in piece.uniqueRotations:
+        rot = piece.get_rotation(i)
+        contour = rot.bottomContour
+        left, right = rot.xRange
+        for x in range(left, right):
+            yield x, min(heights[x + col] - bottomOff
+                         for col, bottomOff in contour) - 1, i
+
+
+def _clamped_drop_placements(b: Board, piece: Piece):
+    # Same as the y-stepping version when it starts at y = 0: a piece that overlaps a block there has no drop
+    # Blocks above the starting spot of the piece are skipped over, so we look for the first block below each column of the piece
+    # Duplicate rotations shifted by a row start from a different spot here, so all four get tried
+    rows = b.get_rows()
     for i in range(4):
         rot = piece.get_rotation(i)
-        left, right = rot.get_width_range()
-        for x in range(left, right, 1):
-            y = max(0, b.get_highest_block() - 5)  # init value for y
-            while True:
-                state = TetrisPlacementState(b, x, y, i)
-                #TODO: Do some math to see if we really need to check legality here
-                if not is_state_legal(state, piece):
-                    break
-                if is_state_goal(state, piece):
-                    moves.add(Move(state.x, state.y, state.rotation))
-                    break
-                y += 1
+        left, right = rot.xRange
+        for x in range(left, right):
+            if any(rows[yOff] & mask for yOff, mask in rot.placementMasks[x]):
+                continue
+            y = BOARD_HEIGHT
+            for col, bottomOff in rot.bottomContour:
+                bit = 1 << (x + col)
+                row = bottomOff + 1
+                while row < BOARD_HEIGHT and not rows[row] & bit:
+                    row += 1
+                y = min(y, row - bottomOff)
+            yield x, y - 1, i
 
-    return moves
+
+def get_all_drop_moves(b: Board, piece: Piece):
+    """
+    This function is very similar to the above one, but rather than performing a bfs to find all of the more unique moves it simply drops the pieces in every single orientation from every legal position. 
+    This generates all legal moves that would involve rotating, moving and the dropping the piece
+    """
+    return set(
+        Move(x, y, rotation) for x, y, rotation in drop_placements(b, piece))
 
 
 def get_all_drop_boards(b: Board, piece: Piece):
@@ -92,65 +147,206 @@ def get_all_drop_boards(b: Board, piece: Piece):
     return boards
 
 
+# drop_placements only takes the fast path when the highest block is at least this far down
+DROP_CLEARANCE = 5
+
+
+def move_order(move: Move) -> tuple:
+    # Placements are scored in this order so ties go to the same move whichever way they were generated
+    return move.rotation, move.x, move.y
+
+
+class DropTable:
+    """
+    Every (rotation, x) drop_placements drops a piece from, as arrays so the drops on many boards are found at once
+    Entry k is rotation rotations[k] at x xs[k], its landing row is min(heights[columns[k]] - bottoms[k]) - 1
+    and masks[k][j] is the row mask it places in the j-th row of its matrix
+    """
+
+    def __init__(self, piece: Piece) -> None:
+        rotations, xs, columns, bottoms, masks = [], [], [], [], []
+        for i in piece.uniqueRotations:
+            rot = piece.get_rotation(i)
+            # The contour is padded to 4 columns by repeating its last column, which does not change the minimum
+            contour = list(rot.bottomContour)
+            contour += contour[-1:] * (4 - len(contour))
+            for x in range(*rot.xRange):
+                rotations.append(i)
+                xs.append(x)
+                columns.append([x + col for col, _ in contour])
+                bottoms.append([bottomOff for _, bottomOff in contour])
+                placement = dict(rot.placementMasks[x])
+                masks.append([placement.get(j, 0) for j in range(4)])
+        self.rotations = rotations
+        self.xs = xs
+        self.columns = np.array(columns, dtype=np.intp)
+        self.bottoms = np.array(bottoms)
+        self.masks = np.array(masks, dtype=np.uint16)
+
+    def __len__(self) -> int:
+        return len(self.xs)
+
+    def move(self, k, y) -> Move:
+        return Move(self.xs[k], int(y), self.rotations[k])
+
+
+DROP_TABLES = {piece.number: DropTable(piece) for piece in PIECES}
+
+
+def drop_afterstates(rows: np.ndarray,
+                     heights: np.ndarray,
+                     piece: Piece,
+                     squares: np.ndarray = None) -> tuple:
+    """
+    Drops the piece from every entry of its DropTable on G boards at once
+    rows are the (G, BOARD_HEIGHT) row bitmasks of the boards, heights their (G, BOARD_WIDTH) column heights
+    and squares their (G, BOARD_HEIGHT, BOARD_WIDTH) square values when colors are kept
+    Every board must have its highest block at DROP_CLEARANCE or below, the boards drop_placements does not clamp
+    Returns the (G, K) landing rows and the afterstates, (G, K, BOARD_HEIGHT) rows or with squares (G, K, BOARD_HEIGHT, BOARD_WIDTH) squares
+    """
+    table = DROP_TABLES[piece.number]
+    ys = (heights[:, table.columns] - table.bottoms).min(axis=2) - 1
+    numBoards, numDrops = ys.shape
+    placed = np.repeat(rows[:, None, :], numDrops, axis=1)
+    boardIndex = np.arange(numBoards)[:, None]
+    dropIndex = np.arange(numDrops)[None, :]
+    for j in range(4):
+        # Rows of the matrix the piece does not use have a zero mask, they only need an index on the board
+        y = np.clip(ys + j, 0, BOARD_HEIGHT - 1)
+        placed[boardIndex, dropIndex, y] |= table.masks[:, j]
+    if squares is None:
+        return ys, clearFullRows(placed)[0]
+    new = (placed ^ rows[:, None, :])[..., None] >> np.arange(
+        BOARD_WIDTH, dtype=np.uint16) & 1 != 0
+    after = np.where(new, np.uint8(piece.number), squares[:, None])
+    return ys, clearFullRows(placed, after)[1]
+
+
+def packAfterstates(b: Board, piece: Piece, moves: list) -> np.ndarray:
+    """
+    Packs the boards make_move would return for each move, without building them
+    Boards without colors give an (N, BOARD_HEIGHT) array of row bitmasks,
+    boards with colors an (N, BOARD_HEIGHT, BOARD_WIDTH) uint8 array of what get_square returns
+    """
+    if not b.has_colors():
+        return np.array([b.get_afterstate_rows(piece, m) for m in moves],
+                        dtype=np.uint16).reshape(-1, BOARD_HEIGHT)
+    rows = b.get_rows()
+    placed = []
+    for m in moves:
+        after = list(rows)
+        for yOff, mask in piece.get_rotation(m.rotation).placementMasks[m.x]:
+            after[m.y + yOff] |= mask
+        placed.append(after)
+    placed = np.array(placed, dtype=np.uint16).reshape(-1, BOARD_HEIGHT)
+    # The squares the piece filled get its color, everything else is copied from the board
+    new = (placed ^ np.array(rows, dtype=np.uint16))[:, :, None] >> np.arange(
+        BOARD_WIDTH, dtype=np.uint16) & 1 != 0
+    squares = np.where(new, np.uint8(piece.number), packSquares([b]))
+    return clearFullRows(placed, squares)[1]
+
+
+def clearFullRows(rows: np.ndarray, squares: np.ndarray = None) -> tuple:
+    """
+    Clears the full rows of a (..., BOARD_HEIGHT) array of row bitmasks like make_move, and of the matching squares if given
+    The rows above every cleared row move down and empty rows come in at the top
+    Returns (rows, squares)
+    """
+    full = rows == FULL_ROW
+    if not full.any():
+        return rows, squares
+    # A stable sort puts the full rows first and keeps the order of the others, then the full rows are emptied
+    order = np.argsort(~full, axis=-1, kind="stable")
+    cleared = np.take_along_axis(full, order, axis=-1)
+    rows = np.where(cleared, np.uint16(0),
+                    np.take_along_axis(rows, order, axis=-1))
+    if squares is not None:
+        squares = np.where(
+            cleared[..., None], np.uint8(0),
+            np.take_along_axis(squares, order[..., None], axis=-2))
+    return rows, squares
+
+
+def best_placement(b: Board,
+                   piece: Piece,
+                   scorer,
+                   featureMatrixGenerator=featureMatrix,
+                   moves=None):
+    """
+    Scores every placement of the piece and only builds the Board for the best one
+    The afterstates are packed straight into an array (see packAfterstates) and featurized together, no Board objects are made for them
+    scorer takes the (N, F) feature matrix and returns the N scores, moves defaults to all drop moves
+    The first of equally scored moves in move_order wins
+    Returns (move, new board, lines cleared) for the best placement, or None if there is no legal placement
+    """
+    if moves is None:
+        moves = get_all_drop_moves(b, piece)
+    moves = sorted(moves, key=move_order)
+    if len(moves) == 0:
+        return None
+    scores = scorer(featureMatrixGenerator(packAfterstates(b, piece, moves),
+                                           b))
+    best = moves[int(np.argmax(scores))]
+    newBoard, linesCleared = b.make_move(piece, best)
+    return best, newBoard, linesCleared
+
+
 def is_state_legal(state: TetrisPlacementState, piece):
-    board = state.board
-    x = state.x
-    y = state.y
-    rotation = state.rotation
-    rot: Rotation = piece.get_rotation(rotation)
+    rot: Rotation = piece.get_rotation(state.rotation)
     # Here we simply want to check if any of the blocks are off screen x and y can be off the screen
-    for off in range(4):
-        if off + x < 0 or off + x >= BOARD_WIDTH:
-            if any(rot.get_column(off)):
-                return False
-        if off + y >= BOARD_HEIGHT:
-            if any(rot.get_row(off)):
-                return False
-    # Here we check to see if any of the blocks are overlapping
-    for xOff in range(4):
-        for yOff in range(4):
-            if rot.get_pos(xOff, yOff):
-                if board.get_square_truthy(x + xOff, y + yOff):
-                    return False
+    left, right = rot.xRange
+    if state.x < left or state.x >= right:
+        return False
+    # Here we check to see if any of the blocks are overlapping, blocks above the board never overlap
+    rows = state.board.get_rows()
+    for yOff, mask in rot.placementMasks[state.x]:
+        y = state.y + yOff
+        if y >= BOARD_HEIGHT:
+            return False
+        if y >= 0 and rows[y] & mask:
+            return False
     return True
 
 
 def is_state_goal(state, piece):
-    board = state.board
-    x = state.x
-    y = state.y
-    rotation = state.rotation
-    rot: Rotation = piece.get_rotation(rotation)
-    for xOff in range(4):
-        for yOff in range(4):
-            if rot.get_pos(xOff, yOff) and board.get_square_truthy(
-                    x + xOff, y + yOff + 1):
-                return True
-            if rot.get_pos(xOff, yOff) and y + yOff + 1 == BOARD_HEIGHT:
-                return True
+    """
+    Checks if the piece is resting on the floor or on a block, this assumes the state is legal
+    For a legal state only the lowest block of each column can be resting on something
+    """
+    rot: Rotation = piece.get_rotation(state.rotation)
+    rows = state.board.get_rows()
+    for colOff, bottomOff in rot.bottomContour:
+        below = state.y + bottomOff + 1
+        if below == BOARD_HEIGHT:
+            return True
+        col = state.x + colOff
+        if 0 <= below < BOARD_HEIGHT and 0 <= col < BOARD_WIDTH and rows[
+                below] >> col & 1:
+            return True
     return False
 
 
-def generate_boards_from_pieces(pieces: list) -> list:
+def generate_boards_from_pieces(pieces: list,
+                                numWorkers=1,
+                                memoryBudget=1 << 30,
+                                spillDir=None) -> list:
     """
     Given a list of pieces, generate all possible boards
+    Returns the boards reachable after the last piece and the losing boards of every level, boards have no colors
+    This holds every board in memory, for long sequences use boardEnumerator.enumerateBoards and stream the boards instead
     """
+    from boardEnumerator import enumerateBoards
     print(f"Generating boards from {len(pieces)} pieces")
     print(f"{[p.name for p in pieces]}")
-    losingBoards = []
-    boards = [Board()]  # Here we are starting with an empty board
-    for piece in pieces:
-        print(
-            f"Generating boards from {piece.name}, {len(boards)} boards so far"
-        )
-        newBoards = []
-        for b in tqdm(boards):
-            b: Board
-            moves = get_all_legal_moves(b, piece, pullFromDict=True, save=True)
-            for m in moves:
-                newBoards.append(b.make_move(piece, m[2], m[0], m[1])[0])
-            if len(moves) == 0:
-                losingBoards.append(b)
-        boards = list(set(newBoards))
-
-    return boards, losingBoards
\ No newline at end of file
+    with enumerateBoards(pieces, numWorkers, memoryBudget,
+                         spillDir) as enumeration:
+        for i, level in enumerate(enumeration.levels, 1):
+            print(
+                f"Level {i} ({level['piece']}): {level['boards']} boards, {level['losing']} losing"
+            )
+        boards = list(enumeration.boards())
+        losingBoards = [
+            Board.from_rows(rows) for keys in enumeration.losing
+            for rows in keys.tolist()
+        ]
+    return boards, losingBoards
@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+
+class TranspositionTable:
+    """
+    Bounded cache for search results that evicts the least recently used entries
+    Every entry has a size (for example the number of boards it holds) and the table keeps the total size under maxSize
+    Hits and misses are counted so the table can be sized
+    """
+
+    def __init__(self, maxSize=200000) -> None:
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the cached value for the key, or None if it is not in the table
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size=1) -> None:
+        if size > self.maxSize:
+            return  # It would evict everything else and then itself
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.maxSize:
+            _, (_, evictedSize) = self.entries.popitem(last=False)
+            self.size -= evictedSize
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": self.hits / lookups if lookups else 0,
+        }
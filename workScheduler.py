@@ -0,0 +1,241 @@
+import multiprocessing
+import os
+import pickle
+import queue
+import time
+import traceback
+from multiprocessing import resource_tracker
+
+
+def workerLoop(workerId, evaluator, tasks, results, currentBatch, holding,
+               initializer, initargs):
+    """
+    Runs in every worker process and evaluates chunks until it is sent None
+    The evaluator lives as long as the worker, so whatever it keeps warm (agents, simulations) is only built once
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batchId, chunkId, payload = task
+        # Leftover copies of chunks from a batch that is already finished are skipped
+        # The chunk is only unpickled after this check, so it may refer to things (like shared memory) that are already gone
+        if batchId != currentBatch.value:
+            continue
+        # Written straight to shared memory, so the chunk is known even if the worker dies before its messages are sent
+        holding[workerId] = chunkId
+        results.put(("start", workerId, batchId, chunkId, None))
+        start = time.perf_counter()
+        try:
+            out = [(index, evaluator(item))
+                   for index, item in pickle.loads(payload)]
+        except Exception:
+            results.put(
+                ("error", workerId, batchId, chunkId, traceback.format_exc()))
+        else:
+            results.put(("done", workerId, batchId, chunkId,
+                         (out, time.perf_counter() - start)))
+        holding[workerId] = -1
+
+
+class WorkScheduler:
+    """
+    Pool of persistent worker processes that all evaluate items with the same evaluator
+    Each batch is split into guided chunks, big ones first and smaller ones towards the end so the workers finish together
+    Results are streamed back as chunks finish, and once nothing is left to hand out,
+    chunks that are taking much longer than expected are handed to an idle worker as well and whichever copy finishes first is used
+    Like multiprocessing.Pool, initializer(*initargs) is called once in every worker when it starts
+    A worker that dies is restarted and the chunk it was running is queued again
+    """
+
+    def __init__(self,
+                 evaluator,
+                 numWorkers=16,
+                 minChunk=1,
+                 chunkDivisor=2,
+                 speculate=True,
+                 straggleFactor=2.0,
+                 pollInterval=0.05,
+                 context=None,
+                 initializer=None,
+                 initargs=()) -> None:
+        self.numWorkers = numWorkers
+        self.minChunk = minChunk
+        # Every chunk is the remaining items split over chunkDivisor * numWorkers
+        self.chunkDivisor = chunkDivisor
+        self.speculate = speculate
+        # A chunk is a straggler once it has run straggleFactor times longer than the average time per item predicts
+        self.straggleFactor = straggleFactor
+        self.pollInterval = pollInterval
+        self.ctx = multiprocessing.get_context(context)
+        if os.name == "posix":
+            # Workers have to share the coordinator's resource tracker, otherwise each one starts its own when it first
+            # attaches to shared memory and reports the blocks the coordinator already unlinked as leaked
+            resource_tracker.ensure_running()
+        self.tasks = self.ctx.Queue()
+        self.results = self.ctx.Queue()
+        self.currentBatch = self.ctx.Value("q", -1)
+        self.batchId = -1
+        self.lastStats = None
+        # worker id -> chunk it is running, so the chunk can be queued again if the worker dies
+        self.holding = self.ctx.Array("q", [-1] * numWorkers, lock=False)
+        self.workerArgs = (evaluator, self.tasks, self.results,
+                           self.currentBatch, self.holding, initializer,
+                           initargs)
+        self.workers = [self.spawn(i) for i in range(numWorkers)]
+
+    def spawn(self, workerId):
+        worker = self.ctx.Process(target=workerLoop,
+                                  args=(workerId, ) + self.workerArgs,
+                                  daemon=True)
+        worker.start()
+        return worker
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def guided_chunks(self, items: list) -> list:
+        chunks = []
+        start = 0
+        while start < len(items):
+            size = max(self.minChunk, (len(items) - start) //
+                       (self.chunkDivisor * self.numWorkers))
+            end = min(start + size, len(items))
+            chunks.append([(i, items[i]) for i in range(start, end)])
+            start += size
+        return chunks
+
+    def map(self, items):
+        """
+        Evaluates every item and yields (index, result) pairs in the order they finish
+        """
+        items = list(items)
+        self.batchId += 1
+        batchId = self.batchId
+        self.currentBatch.value = batchId
+        guided = self.guided_chunks(items)
+        chunkSizes = [len(chunk) for chunk in guided]
+        chunks = [pickle.dumps(chunk) for chunk in guided]
+        for chunkId, chunk in enumerate(chunks):
+            self.tasks.put((batchId, chunkId, chunk))
+        pending = set(range(len(chunks)))
+        untaken = set(pending)
+        # chunk id -> [time the first copy started, number of copies running]
+        running = {}
+        deaths = 0
+        speculated = set()
+        busy = [0.0] * self.numWorkers
+        doneSeconds = 0.0
+        doneItems = 0
+        duplicates = 0
+        startTime = time.perf_counter()
+        while pending:
+            try:
+                kind, workerId, messageBatch, chunkId, payload = self.results.get(
+                    timeout=self.pollInterval)
+            except queue.Empty:
+                kind = None
+                if time.perf_counter() - startTime > 3:
+                    print("STATE", pending, untaken, running, list(self.holding), [(w.pid, w.is_alive(), w.exitcode) for w in self.workers], self.tasks.qsize(), flush=True)
+                    time.sleep(1)
+                deaths += self.revive(batchId, chunks, pending, untaken,
+                                      running)
+                # Workers that die as soon as they are restarted (a failing initializer) would otherwise be restarted forever
+                if deaths > self.numWorkers:
+                    raise RuntimeError(
+                        f"{deaths} workers died during batch {batchId}")
+            if kind is not None and messageBatch == batchId:
+                if kind == "error":
+                    raise RuntimeError(
+                        f"Worker {workerId} failed on chunk {chunkId}:\n{payload}"
+                    )
+                if kind == "start":
+                    # A copy can start after another copy already finished the chunk
+                    if chunkId not in pending:
+                        continue
+                    untaken.discard(chunkId)
+                    running.setdefault(chunkId,
+                                       [time.perf_counter(), 0])[1] += 1
+                elif kind == "done":
+                    out, seconds = payload
+                    busy[workerId] += seconds
+                    if chunkId in pending:
+                        pending.remove(chunkId)
+                        running.pop(chunkId, None)
+                        doneSeconds += seconds
+                        doneItems += len(out)
+                        yield from out
+                    else:
+                        duplicates += 1
+            if self.speculate and not untaken and doneItems > 0:
+                speculated.update(
+                    self.redispatch(batchId, chunks, chunkSizes, running,
+                                    speculated, doneSeconds / doneItems))
+        wallTime = time.perf_counter() - startTime
+        utilization = sum(busy) / (self.numWorkers *
+                                   wallTime) if wallTime > 0 else 0.0
+        self.lastStats = dict(batch=batchId,
+                              items=len(items),
+                              chunks=len(chunks),
+                              wallTime=wallTime,
+                              busyTime=busy,
+                              utilization=utilization,
+                              speculative=len(speculated),
+                              duplicates=duplicates,
+                              restarted=deaths)
+
+    def revive(self, batchId, chunks, pending, untaken, running) -> int:
+        # Restarts dead workers and queues the chunk each one was running again
+        died = 0
+        for workerId, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            died += 1
+            chunkId = self.holding[workerId]
+            self.holding[workerId] = -1
+            self.workers[workerId] = self.spawn(workerId)
+            if chunkId not in pending:
+                continue
+            if chunkId in running:
+                running[chunkId][1] -= 1
+                if running[chunkId][1] == 0:
+                    del running[chunkId]
+            if chunkId not in running:
+                untaken.add(chunkId)
+            self.tasks.put((batchId, chunkId, chunks[chunkId]))
+        return died
+
+    def redispatch(self, batchId, chunks, chunkSizes, running, speculated,
+                   secondsPerItem) -> list:
+        # Hands a second copy of the slowest running chunks to the idle workers
+        idle = self.numWorkers - sum(copies for _, copies in running.values())
+        now = time.perf_counter()
+        stragglers = sorted((started, chunkId)
+                            for chunkId, (started, _) in running.items()
+                            if chunkId not in speculated and now -
+                            started > self.straggleFactor * secondsPerItem *
+                            chunkSizes[chunkId])
+        redispatched = []
+        for _, chunkId in stragglers[:max(idle, 0)]:
+            self.tasks.put((batchId, chunkId, chunks[chunkId]))
+            redispatched.append(chunkId)
+        return redispatched
+
+    def stats(self) -> dict:
+        """
+        Timing of the last finished batch: wall time, busy seconds per worker, utilization and how many chunks were speculated
+        """
+        return self.lastStats
+
+    def close(self) -> None:
+        for _ in self.workers:
+            self.tasks.put(None)
+        for w in self.workers:
+            w.join(timeout=5)
+            if w.is_alive():
+                w.terminate()